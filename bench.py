@@ -0,0 +1,351 @@
+#!/usr/bin/env python3.8
+
+# Benchmarks for the hot paths of the bot. Each one runs against a throwaway database.
+#   python3 bench.py            # run everything
+#   python3 bench.py connections
+
+import argparse, asyncio, contextlib, datetime, io, json, os, sqlite3, tempfile, time
+from unittest import mock
+
+import pytz
+from pykeybasebot.types import chat1
+
+import bot, database, keybase, parse, reminders, user, util
+from conversation import Conversation
+
+BENCH_BOT = '__benchbot__'
+BENCH_USER = '__benchuser__'
+BENCH_CONV_ID = 'bench0001'
+BENCH_CONV_JSON = {"id": BENCH_CONV_ID,
+        "channel": {"name": BENCH_USER + "," + BENCH_BOT, "members_type": "impteamnative"}}
+NOW_UTC = datetime.datetime(2018, 4, 9, 1, 2, 28, tzinfo=pytz.utc)
+
+BENCHMARKS = {}
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+@contextlib.contextmanager
+def bench_db():
+    with tempfile.TemporaryDirectory() as d:
+        db = os.path.join(d, 'bench.db')
+        config = bot.Config(db, BENCH_BOT, BENCH_USER)
+        database.setup(db)
+        try:
+            yield config
+        finally:
+            database.close_all()
+
+@contextlib.contextmanager
+def quiet():
+    # The bot prints a line or two per message, which would drown out the results.
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+def report(name, seconds):
+    print("  {:<60} {:>10.1f} us".format(name, seconds * 1e6))
+
+class Unpooled(object):
+    '''Stands in for database.connect, opening a fresh connection for every `with` block like the
+    models did before connections were pooled.'''
+    def __init__(self):
+        self.count = 0
+
+    @contextlib.contextmanager
+    def connect(self, db):
+        self.count += 1
+        c = sqlite3.connect(db)
+        c.row_factory = sqlite3.Row
+        try:
+            with c:
+                yield c
+        finally:
+            c.close()
+
+def run_messages(config, texts):
+    async def run():
+        conv = Conversation.lookup_or_json(BENCH_CONV_ID, BENCH_CONV_JSON, config.db)
+        for text in texts:
+            message = keybase.Message.inject(text, BENCH_USER, BENCH_CONV_ID, conv.channel, config.db)
+            await bot.process_message(None, config, message, conv)
+    asyncio.run(run())
+
+@benchmark
+def connections(n=200):
+    '''Connect/close overhead per inbound message and per scheduler tick.'''
+    texts = ["remind me to foo in 30 minutes", "list", "thanks", "set my timezone to US/Pacific"]
+    print("connections: {} messages, {} scheduler ticks".format(n * len(texts), n))
+    with mock.patch('keybase.send'), mock.patch('util.now_utc', return_value=NOW_UTC):
+        for label, unpooled in (("sqlite3.connect per call", True), ("pooled", False)):
+            with bench_db() as config:
+                counter = Unpooled()
+                connect = counter.connect if unpooled else database.connect
+                with mock.patch('database.connect', connect), quiet():
+                    start = time.perf_counter()
+                    for _ in range(n):
+                        run_messages(config, texts)
+                    per_message = (time.perf_counter() - start) / (n * len(texts))
+                    opened_per_message = counter.count / (n * len(texts))
+
+                    counter.count = 0
+                    start = time.perf_counter()
+                    for _ in range(n):
+                        reminders.get_due_reminders(config.db, error_limit=10)
+                        bot.vacuum_old_reminders(config)
+                    per_tick = (time.perf_counter() - start) / n
+                    opened_per_tick = counter.count / n
+            print("  " + label)
+            report("per message ({:.1f} connects)".format(opened_per_message), per_message)
+            report("per tick ({:.1f} connects)".format(opened_per_tick), per_tick)
+
+def vacuum_all(config):
+    # The vacuum as it was, in one statement.
+    with database.connect(config.db) as c:
+        return c.execute('''DELETE FROM reminders WHERE rowid IN (
+            SELECT reminders.rowid FROM reminders
+            INNER JOIN conversations ON reminders.conv_id = conversations.id
+            WHERE conversations.reminder_rowid != reminders.rowid
+            AND reminders.deleted = 1
+        )''').rowcount
+
+@benchmark
+def vacuum(n=200000):
+    '''The longest the database is held by one vacuum run, with a backlog of old reminders.'''
+    print("vacuum: {} old reminders".format(n))
+    for label, fn in (("one statement", vacuum_all), ("batched", bot.vacuum_old_reminders)):
+        with bench_db() as config, quiet():
+            Conversation.lookup_or_json(BENCH_CONV_ID, BENCH_CONV_JSON, config.db)
+            with database.connect(config.db) as c:
+                c.executemany('''INSERT INTO reminders (reminder_time, created_time, body, user, conv_id, deleted)
+                    VALUES (?, ?, 'foo', ?, ?, 1)''', ((i, i, BENCH_USER, BENCH_CONV_ID) for i in range(n)))
+                c.execute('UPDATE conversations SET reminder_rowid=1 WHERE id=?', (BENCH_CONV_ID,))
+            start = time.perf_counter()
+            rows = fn(config)
+            seconds = time.perf_counter() - start
+        report("{} ({} rows)".format(label, rows), seconds)
+
+# Messages like the ones the bot gets, for the parsing benchmarks
+MESSAGES = [
+    "remind me to foo tomorrow",
+    "remind me to paint dan's fence at 10:30pm today",
+    "remind me every tuesday 8am to eat a quiche",
+    "remind me on every other tuesday at 10am to eat a quiche",
+    "remind me every 6 hours to eat a quiche",
+    "remind me in 20 minutes to call mom",
+    "reminder to take out the trash on friday",
+    "list",
+    "show me my reminders",
+    "thanks",
+    "hi",
+    "help",
+    "set my timezone to US/Pacific",
+    "what are you made of",
+    "delete the foo reminder",
+    "snooze for 20 minutes",
+    "undo",
+    "this doesn't mean anything",
+]
+
+@benchmark
+def parsing(n=20):
+    '''Time to parse one message, over a mix of typical messages.'''
+    print("parsing: {} messages".format(n * len(MESSAGES)))
+    with mock.patch('util.now_utc', return_value=NOW_UTC), bench_db() as config, quiet():
+        conv = Conversation.lookup_or_json(BENCH_CONV_ID, BENCH_CONV_JSON, config.db)
+        timings = {text: 0.0 for text in MESSAGES}
+        for _ in range(n):
+            for text in MESSAGES:
+                message = keybase.Message.inject(text, BENCH_USER, BENCH_CONV_ID, conv.channel, config.db)
+                start = time.perf_counter()
+                parse.parse_message(message, conv, config)
+                timings[text] += time.perf_counter() - start
+    for text in MESSAGES:
+        report(text, timings[text] / n)
+    report("mean", sum(timings.values()) / (n * len(MESSAGES)))
+
+@benchmark
+def queries():
+    '''SQL statements run to parse one message, with nothing about the user cached yet.'''
+    print("queries: {} messages".format(len(MESSAGES)))
+    with mock.patch('util.now_utc', return_value=NOW_UTC), bench_db() as config, quiet():
+        conv = Conversation.lookup_or_json(BENCH_CONV_ID, BENCH_CONV_JSON, config.db)
+        for body in ("foo", "bar"):
+            reminders.Reminder(body, NOW_UTC + datetime.timedelta(days=1), None, BENCH_USER,
+                    BENCH_CONV_ID, config.db).store()
+        statements = []
+        database.get_connection(config.db).set_trace_callback(statements.append)
+        counts = {}
+        for text in MESSAGES:
+            user._cache.clear()
+            message = keybase.Message.inject(text, BENCH_USER, BENCH_CONV_ID, conv.channel, config.db)
+            del statements[:]
+            parse.parse_message(message, conv, config)
+            counts[text] = len([sql for sql in statements if not sql.startswith(('BEGIN', 'COMMIT'))])
+        database.get_connection(config.db).set_trace_callback(None)
+    for text in MESSAGES:
+        print("  {:<60} {:>10}".format(text, counts[text]))
+    print("  {:<60} {:>10.1f}".format("mean", sum(counts.values()) / len(MESSAGES)))
+
+# Whens as try_parse_when gets them (after the AM/PM fixups and taking off any repetition)
+WHENS = [
+    "in 5 minutes", "in an hour", "in 2 hours", "in 3 days", "in 2 weeks", "in 1 month",
+    "tomorrow", "tomorrow at 10am", "tomorrow at 22:30", "at 5pm", "at 22:30", "10:30pm",
+    "on tuesday", "tuesday at 8am", "next week", "at 10:30pm today", "friday at 23:15",
+    "next tuesday", "the 10th", "april 10", "tonight", "this weekend", "noon", "in half an hour",
+]
+
+@benchmark
+def when(n=20):
+    '''How many whens the fast path reads, and how long they take with and without it.'''
+    print("when: {} whens".format(len(WHENS)))
+    base = NOW_UTC.astimezone(pytz.timezone('US/Eastern')).replace(tzinfo=None)
+    settings = {'PREFER_DATES_FROM': 'future', 'PREFER_DAY_OF_MONTH': 'first', 'TO_TIMEZONE': 'UTC',
+            'TIMEZONE': 'US/Eastern', 'RETURN_AS_TIMEZONE_AWARE': True, 'RELATIVE_BASE': base}
+    tz = pytz.timezone('US/Eastern')
+    hits = [w for w in WHENS if parse.try_parse_common_when(w, base, tz)]
+    timings = {}
+    for label, fn in (("dateparser", lambda w: parse.dateparser.parse(w, settings=settings)),
+            ("fast path, then dateparser", lambda w: parse.try_parse_common_when(w, base, tz)
+                or parse.dateparser.parse(w, settings=settings))):
+        start = time.perf_counter()
+        for _ in range(n):
+            for w in WHENS:
+                fn(w)
+        timings[label] = (time.perf_counter() - start) / (n * len(WHENS))
+        report(label, timings[label])
+    print("  fast path read {}/{} ({:.0f}%)".format(len(hits), len(WHENS), 100 * len(hits) / len(WHENS)))
+
+def scan_text_match(upcoming, word_lists):
+    # How delete-by-text used to score reminders: tokenizing every body for every message.
+    best = (None, 0)
+    for reminder in upcoming:
+        body_words = parse.nltk.word_tokenize(reminder.body)
+        for words in word_lists:
+            matches = len([w for w in body_words if w in words])
+            if matches and matches**2 > best[1]:
+                best = (reminder, matches**2)
+    return best
+
+@benchmark
+def delete_by_text(n=5000):
+    '''Finding the reminder "delete the quiche reminder" means in a conversation with lots of them.'''
+    print("delete_by_text: {} reminders".format(n))
+    words = [["quiche"]]
+    with mock.patch('util.now_utc', return_value=NOW_UTC), bench_db() as config:
+        conv = Conversation.lookup_or_json(BENCH_CONV_ID, BENCH_CONV_JSON, config.db)
+        with database.connect(config.db) as c:
+            c.executemany('''INSERT INTO reminders (reminder_time, created_time, body, user, conv_id, deleted)
+                VALUES (?, ?, ?, ?, ?, 0)''', ((util.to_ts(NOW_UTC) + 60 * (i + 1), util.to_ts(NOW_UTC),
+                    "eat a quiche" if i == n // 2 else "call mom about the fence {}".format(i),
+                    BENCH_USER, BENCH_CONV_ID) for i in range(n)))
+        upcoming = conv.upcoming_reminders()
+        for label, fn in (("tokenizing every body", scan_text_match),
+                ("index, first message (builds it)", lambda u, w: u.best_text_match(w)),
+                ("index, after that", lambda u, w: u.best_text_match(w))):
+            start = time.perf_counter()
+            fn(upcoming, words)
+            report(label, time.perf_counter() - start)
+
+async def process_on_database_thread(bot_, config, message, conv):
+    # How messages used to be handled: parsed inside the same database job that writes them.
+    outbox = keybase.Outbox(bot_, config)
+    def handle():
+        with database.unit_of_work(config.db):
+            msg_type, data = parse.parse_message(message, conv, config)
+            if bot.process_message_inner(config, message, conv, outbox, msg_type, data):
+                conv.set_active()
+    await database.run(handle)
+    await outbox.flush()
+
+@benchmark
+def reminder_loop(n=10):
+    '''How long the reminder loop's database calls wait while messages are being handled.'''
+    print("reminder_loop: {} messages, due reminders fetched every ms".format(n * len(MESSAGES)))
+    for label, process in (("parsed on the database thread", process_on_database_thread),
+            ("parsed on its own thread", bot.process_message)):
+        with mock.patch('keybase.send'), mock.patch('util.now_utc', return_value=NOW_UTC), \
+                bench_db() as config, quiet():
+            async def run():
+                conv = Conversation.lookup_or_json(BENCH_CONV_ID, BENCH_CONV_JSON, config.db)
+                # dateparser's first parse loads its language data, which isn't what's measured
+                for text in MESSAGES:
+                    parse.parse_message(keybase.Message.inject(text, BENCH_USER, BENCH_CONV_ID,
+                        conv.channel, config.db), conv, config)
+                waits = []
+                done = False
+                async def tick():
+                    while not done:
+                        start = time.perf_counter()
+                        await database.run(reminders.get_due_reminders, config.db, bot.ERROR_LIMIT)
+                        waits.append(time.perf_counter() - start)
+                        await asyncio.sleep(0.001)
+                ticks = asyncio.create_task(tick())
+                for _ in range(n):
+                    await asyncio.gather(*(process(None, config, keybase.Message.inject(text, BENCH_USER,
+                        BENCH_CONV_ID, conv.channel, config.db), conv) for text in MESSAGES))
+                done = True
+                await ticks
+                return waits
+            waits = sorted(asyncio.run(run()))
+        print("  " + label)
+        report("median wait ({} calls)".format(len(waits)), waits[len(waits) // 2])
+        report("mean wait", sum(waits) / len(waits))
+        report("longest wait", waits[-1])
+
+def message_from_json(msg_summary, db):
+    # How messages used to be read: the summary out to json and back, then five fields picked out.
+    msg = json.loads(msg_summary.to_json())
+    return keybase.Message(msg_summary.conv_id, msg["content"]["text"]["body"], msg["sender"]["username"],
+            msg["channel"]["name"], msg["channel"]["members_type"],
+            (msg.get("bot_info", {}) or {}).get("bot_username"), db)
+
+@benchmark
+def message(n=2000):
+    '''Turning an incoming MsgSummary into a keybase.Message.'''
+    print("message: {} events".format(n))
+    summary = chat1.MsgSummary.from_dict({
+        "id": 2, "conv_id": BENCH_CONV_ID, "sent_at": 1522813326, "sent_at_ms": 1522813326658,
+        "unread": True, "prev": [{"hash": "DEZRY/2G+NYYgB34g1X9ocuFqfBBDIfEHvT+qOwotqE=", "id": 1}],
+        "channel": {"name": BENCH_USER + "," + BENCH_BOT, "members_type": "impteamnative",
+            "topic_type": "chat", "public": False},
+        "sender": {"uid": "653ba091fa61606e5a3c8fb2086b3419", "username": BENCH_USER,
+            "device_id": "c4aec52a455b551af3b042c46537fc18", "device_name": "phone"},
+        "bot_info": {"bot_uid": "f1f49e2da3db6392b47dc913b4e85519", "bot_username": BENCH_BOT},
+        "content": {"type": "text", "text": {"body": "remind me to foo tomorrow"}}})
+    for label, fn in (("json round trip", message_from_json),
+            ("read from the summary", keybase.Message.from_msgsummary)):
+        start = time.perf_counter()
+        for _ in range(n):
+            fn(summary, "bench.db")
+        report(label, (time.perf_counter() - start) / n)
+
+def step_occurrence(t, interval, nth, after):
+    # How set_next_reminder used to find the next occurrence.
+    new = reminders.INTERVALS[interval](t, nth)
+    while new < after:
+        new = reminders.INTERVALS[interval](new, nth)
+    return new
+
+@benchmark
+def recurrence(n=20):
+    '''Finding the next occurrence of a repeating reminder after the bot was offline.'''
+    print("recurrence: next occurrence after a 30 day gap")
+    start_time = NOW_UTC.replace(day=31, month=1)
+    after = start_time + datetime.timedelta(days=30)
+    for interval in reminders.INTERVALS:
+        for label, fn in (("stepping", step_occurrence), ("closed form", reminders.next_occurrence)):
+            start = time.perf_counter()
+            for _ in range(n):
+                fn(start_time, interval, 1, after)
+            report("every {} ({})".format(interval, label), (time.perf_counter() - start) / n)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run: ' + ', '.join(sorted(BENCHMARKS)))
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: ' + ', '.join(sorted(unknown)))
+    for name in args.names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
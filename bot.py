@@ -1,12 +1,12 @@
 #!/usr/bin/env python3.8
 
-import argparse, asyncio, configparser, logging, os, pytz, sentry_sdk, signal, sqlite3, sys, time, traceback
+import argparse, asyncio, configparser, logging, os, pytz, sentry_sdk, signal, sys, time, traceback, weakref
 
 from pykeybasebot import Bot
 from pykeybasebot.types import chat1
 
 from commands import advertise_commands, clear_command_advertisements
-import conversation, database, keybase, parse, reminders, util
+import conversation, database, keybase, metrics, parse, reminders, scheduler, util
 from conversation import Conversation
 
 logging.basicConfig(level=logging.INFO)
@@ -14,10 +14,9 @@ logging.basicConfig(level=logging.INFO)
 # Static response messages
 HELP_WHEN = "Sorry, I didn't understand. When should I set the reminder for?" \
         " You can say something like \"tomorrow at 10am\" or \"in 30 minutes\"."
-HELP_TZ = "Sorry, I couldn't understand your timezone. It can be something like \"US/Pacific\"" \
-        " or \"GMT\". If you're stuck, I can use any of the timezones in this list:" \
-        " https://stackoverflow.com/questions/13866926/python-pytz-list-of-timezones."\
-        " Be sure to get the capitalization right!"
+HELP_TZ = "Sorry, I couldn't understand your timezone. It can be something like \"US/Pacific\"," \
+        " \"GMT\" or a city like \"Chicago\". If you're stuck, I can use any of the timezones in this list:" \
+        " https://stackoverflow.com/questions/13866926/python-pytz-list-of-timezones."
 UNKNOWN = "Sorry, I didn't understand that message."
 PROMPT_HELP = "Hey there, I didn't understand that." \
         " Just say \"help\" to see what sort of things I understand."
@@ -44,21 +43,23 @@ If you have any feedback or suggestions, @%s would love to hear them."""
 DEBUG = "Thanks! Now I'll log verbose error messages in this conversation. say #nodebug to turn it off."
 NODEBUG = "Ok! Debug mode is off now."
 
-# Returns True iff I interacted with the user.
-async def process_message_inner(bot, config, message, conv):
-    if not message.is_private_channel() \
-            and message.bot_username != config.username \
-            and not config.username in message.text \
-            and not conv.is_strong_context():
-        # print("Ignoring message not for me")
-        return False
+# A reminder that failed to send more than this many times is moved to dead_reminders.
+ERROR_LIMIT = 10
 
+def is_for_me(config, message, conv):
+    return message.is_private_channel() \
+            or message.bot_username == config.username \
+            or config.username in message.text \
+            or conv.is_strong_context()
+
+# Acts on a message parse.parse_message read as (msg_type, data). Returns True iff I interacted
+# with the user.
+def process_message_inner(config, message, conv, outbox, msg_type, data):
     # TODO need some sort of onboarding for first-time user
 
-    msg_type, data = parse.parse_message(message, conv, config)
     print("Received message parsed as " + str(msg_type) + " in context " + str(conv.context))
     if msg_type == parse.MSG_REMINDER and message.user().timezone is None:
-        await keybase.send(bot, conv.id, ASSUME_TZ)
+        outbox.send(conv.id, ASSUME_TZ)
         message.user().set_timezone("US/Eastern")
 
     if msg_type == parse.MSG_REMINDER:
@@ -66,31 +67,31 @@ async def process_message_inner(bot, config, message, conv):
         reminder.store()
         if not reminder.reminder_time:
             conv.set_context(conversation.CTX_WHEN, reminder=reminder)
-            await keybase.send(bot, conv.id, WHEN)
+            outbox.send(conv.id, WHEN)
             return True
         else:
             conv.set_context(conversation.CTX_SET, reminder=reminder)
-            await keybase.send(bot, conv.id, reminder.confirmation())
+            outbox.send(conv.id, reminder.confirmation())
             return True
 
     elif msg_type == parse.MSG_STFU:
         conv.clear_context()
-        await keybase.send(bot, conv.id, OK)
+        outbox.send(conv.id, OK)
         return True
 
     elif msg_type == parse.MSG_HELP:
         message.user().set_seen_help()
         conv.clear_weak_context()
-        await keybase.send(bot, conv.id, HELP % config.owner)
+        outbox.send(conv.id, HELP % config.owner)
         return True
 
     elif msg_type == parse.MSG_TIMEZONE:
         message.user().set_timezone(data)
         if conv.context == conversation.CTX_WHEN:
-            await keybase.send(bot, conv.id, ACK_WHEN)
+            outbox.send(conv.id, ACK_WHEN)
             return True
         conv.clear_weak_context()
-        await keybase.send(bot, conv.id, ACK)
+        outbox.send(conv.id, ACK)
         return True
 
     elif msg_type == parse.MSG_WHEN:
@@ -98,19 +99,17 @@ async def process_message_inner(bot, config, message, conv):
         reminder.set_time(data[0], data[1])
         confirmation = reminder.confirmation()
         conv.set_context(conversation.CTX_SET, reminder=reminder)
-        await keybase.send(bot, conv.id, confirmation)
+        outbox.send(conv.id, confirmation)
         return True
 
     elif msg_type == parse.MSG_LIST:
-        reminders = conv.get_all_reminders()
+        upcoming = conv.get_all_reminders()
         conv.clear_weak_context()
-        if not len(reminders):
-            await keybase.send(bot, conv.id, NO_REMINDERS)
+        if not len(upcoming):
+            outbox.send(conv.id, NO_REMINDERS)
             return True
-        response = LIST_INTRO
-        for i, reminder in enumerate(reminders, start=1):
-            response += str(i) + ". " + reminder.body + " - " + reminder.human_time(full=True) + "\n"
-        await keybase.send(bot, conv.id, response)
+        for page in paginate(LIST_INTRO, reminders.list_lines(upcoming)):
+            outbox.send(conv.id, page)
         return True
 
     elif msg_type == parse.MSG_UNDO:
@@ -119,17 +118,17 @@ async def process_message_inner(bot, config, message, conv):
         elif conv.context == conversation.CTX_DELETED:
             conv.get_reminder().undelete()
         conv.clear_weak_context()
-        await keybase.send(bot, conv.id, OK)
+        outbox.send(conv.id, OK)
         return True
 
     elif msg_type == parse.MSG_SOURCE:
         conv.clear_weak_context()
-        await keybase.send(bot, conv.id, SOURCE)
+        outbox.send(conv.id, SOURCE)
         return True
 
     elif msg_type == parse.MSG_UNKNOWN_TZ:
         conv.clear_weak_context()
-        await keybase.send(bot, conv.id, HELP_TZ)
+        outbox.send(conv.id, HELP_TZ)
         return True
 
     elif msg_type == parse.MSG_ACK:
@@ -138,17 +137,17 @@ async def process_message_inner(bot, config, message, conv):
 
     elif msg_type == parse.MSG_GREETING:
         conv.clear_weak_context()
-        await keybase.send(bot, conv.id, data)
+        outbox.send(conv.id, data)
         return True
 
     elif msg_type == parse.MSG_DEBUG:
         conv.set_debug(True)
-        await keybase.send(bot, conv.id, DEBUG)
+        outbox.send(conv.id, DEBUG)
         return True
 
     elif msg_type == parse.MSG_NODEBUG:
         conv.set_debug(False)
-        await keybase.send(bot, conv.id, NODEBUG)
+        outbox.send(conv.id, NODEBUG)
         return True
 
     elif msg_type == parse.MSG_DELETE:
@@ -157,41 +156,111 @@ async def process_message_inner(bot, config, message, conv):
         conv.set_context(conversation.CTX_DELETED, reminder)
         msg = "Alright, I've deleted the reminder to " + reminder.body + " that was set for " + \
             reminder.human_time(preposition=False) + "."
-        await keybase.send(bot, conv.id, msg)
+        outbox.send(conv.id, msg)
         return True
 
     elif msg_type == parse.MSG_SNOOZE:
         if conv.context != conversation.CTX_REMINDED:
-            await keybase.send(bot, conv.id, "Not sure what to snooze.")
+            outbox.send(conv.id, "Not sure what to snooze.")
             return True
-        conv.get_reminder().snooze_until(data.time)
-        conv.set_context(conversation.CTX_SET, conv.get_reminder())
-        await keybase.send(bot, conv.id, "Ok. I'll remind you again in " + data.phrase + ".")
+        snoozed = conv.get_reminder().snooze_until(data.time)
+        conv.set_context(conversation.CTX_SET, snoozed)
+        outbox.send(conv.id, "Ok. I'll remind you again in " + data.phrase + ".")
         return True
 
     elif msg_type == parse.MSG_UNKNOWN:
         # I don't think an unknown message should clear context at all
         #conv.clear_weak_context()
-        await keybase.debug(bot, conv, "Message from @" + message.user().name + " parsed UNKNOWN: " \
-                + message.text, config)
+        outbox.debug(conv, "Message from @" + message.user().name + " parsed UNKNOWN: " \
+                + message.text)
         if conv.context == conversation.CTX_WHEN:
-            await keybase.send(bot, conv.id, HELP_WHEN)
+            outbox.send(conv.id, HELP_WHEN)
             return True
         else: # CTX_NONE/weak
             if conv.is_recently_active() or message.user().has_seen_help:
-                await keybase.send(bot, conv.id, UNKNOWN)
+                outbox.send(conv.id, UNKNOWN)
                 return True
-            await keybase.send(bot, conv.id, PROMPT_HELP)
+            outbox.send(conv.id, PROMPT_HELP)
             return True
 
     # Shouldn't be able to get here
     print(msg_type, data)
     assert False, "unexpected parsed msg_type"
 
+# Splits a long list into messages of at most about this many characters.
+LIST_PAGE_LENGTH = 4000
+
+def paginate(intro, lines):
+    pages = []
+    page = [intro]
+    length = len(intro)
+    page_lines = 0
+    for line in lines:
+        # every page gets at least one line, however long
+        if page_lines and length + len(line) > LIST_PAGE_LENGTH:
+            pages.append("".join(page))
+            page = []
+            length = 0
+            page_lines = 0
+        page.append(line)
+        length += len(line)
+        page_lines += 1
+    pages.append("".join(page))
+    return pages
+
+# One per conversation with a message being handled (see process_message)
+_conversation_locks = weakref.WeakValueDictionary()
+
+def conversation_lock(conv_id):
+    lock = _conversation_locks.get(conv_id)
+    if lock is None:
+        lock = _conversation_locks[conv_id] = asyncio.Lock()
+    return lock
+
 async def process_message(bot, config, message, conv):
-    active = await process_message_inner(bot, config, message, conv)
-    if active:
-        conv.set_active()
+    if not is_for_me(config, message, conv):
+        metrics.incr("events.dropped.not_for_me_after_lookup")
+        return
+    # A conversation's messages are handled one at a time, so each is parsed in the context the
+    # one before it left.
+    async with conversation_lock(conv.id):
+        # Looking the user up can add them, and all writes happen on the database thread.
+        await database.run(message.user)
+        msg_type, data = await parse.run(parse.parse_message, message, conv, config)
+        # Everything the message changes is written in one transaction. Replies go out after it
+        # commits, so nothing is sent for a message whose changes were rolled back.
+        outbox = keybase.Outbox(bot, config)
+        def handle():
+            with database.unit_of_work(config.db):
+                if process_message_inner(config, message, conv, outbox, msg_type, data):
+                    conv.set_active()
+        await database.run(handle)
+    await outbox.flush()
+
+# Why an event can be dropped before its conversation is looked up: a reason, counted as
+# events.dropped.<reason>, or None if it needs a closer look. Only reads the event and the
+# cached strong contexts, because in big teams almost every message is for someone else.
+def prefilter(event, config):
+    msg = event.msg
+    if event.error or msg is None:
+        return None
+    if msg.channel is not None and msg.channel.name == config.debug_team:
+        return "debug_team"
+    if msg.content.type_name != chat1.MessageTypeStrings.TEXT.value:
+        # edits, people joining the channel, etc
+        return "not_text"
+    if msg.sender.username == config.username:
+        # my own messages
+        return "own"
+    if msg.channel is None:
+        return None
+    private = msg.channel.members_type != "team" and msg.channel.name.count(',') <= 1
+    for_me = msg.bot_info is not None and msg.bot_info.bot_username == config.username
+    mentioned = msg.content.text is not None and config.username in msg.content.text.body
+    if not (private or for_me or mentioned) \
+            and conversation.in_strong_context(config.db, msg.conv_id) is False:
+        return "not_for_me"
+    return None
 
 def get_conv(event, config):
     if event.conv:
@@ -201,7 +270,7 @@ def get_conv(event, config):
             raise RuntimeError("KbEvent msg has no conv_id")
         if event.msg.channel:
             return Conversation.lookup_or_convsummary(event.msg.conv_id, event.msg, config.db)
-        return Conversation.lookup(event.msg.conv_id)
+        return Conversation.lookup(event.msg.conv_id, config.db)
     raise RuntimeError("KbEvent has no conv or msg")
 
 class Handler:
@@ -209,9 +278,14 @@ class Handler:
         self.config = config
     async def __call__(self, bot, event):
         config = self.config
+        metrics.incr("events.received")
+        reason = prefilter(event, config)
+        if reason is not None:
+            metrics.incr("events.dropped." + reason)
+            return
         with sentry_sdk.push_scope() as scope:
             try:
-                conv = get_conv(event, config)
+                conv = await database.run(get_conv, event, config)
                 scope.set_tag("conv_id", conv.id)
 
                 if conv.channel == config.debug_team:
@@ -231,23 +305,14 @@ class Handler:
                         sentry_sdk.capture_exception()
                         return
 
-                if event.msg.content.type_name != chat1.MessageTypeStrings.TEXT.value:
-                    # Ignore messages like edits and people joining the channel
-                    print("Ignoring non text message :  " + str(event.msg.content.type_name))
-                    return
-
-                if event.msg.sender.username == config.username:
-                    # Don't process my own messaages
-                    return
-
                 scope.set_user({"username": event.msg.sender.username})
 
                 try:
                     kb_msg = keybase.Message.from_msgsummary(event.msg, config.db)
                     await process_message(bot, config, kb_msg, conv)
                 except Exception as e:
-                    if hasattr(e, 'message') and e.message.startswith("user is not in conversation:  uid: "):
-                        # above error happens when bot doesn't have write permission in the conv
+                    if keybase.is_permanent_error(e):
+                        # e.g. the bot doesn't have write permission in the conv
                         # it can be ignored
                         # TODO: suppose you could DM the person who sent you the message to let them know
                         return
@@ -266,49 +331,125 @@ class Handler:
                         from_u = event.msg.sender.username
                         print("Error processing message: {}".format(e.message))
                         print("The message, sent by @" + from_u + " was: " + text, config)
-                    conv.set_context(conversation.CTX_NONE)
+                    # The message's own writes were rolled back, but conv may still hold the
+                    # context it was moving to.
+                    await database.run(conv.set_context, conversation.CTX_NONE)
                     return
             except:
                 if not config.sentry_dsn:
                     raise
                 sentry_sdk.capture_exception()
 
-async def send_reminders(bot, config):
-    for reminder in reminders.get_due_reminders(config.db, error_limit=10):
-        with sentry_sdk.push_scope() as scope:
-            scope.user = {"username": reminder.username}
-            scope.set_tag("conv_id", reminder.conv_id)
-            try:
-                conv = Conversation.lookup(reminder.conv_id, config.db)
-                await keybase.send(bot, conv.id, reminder.reminder_text())
-                print("sent a reminder for", reminder.reminder_time)
-                reminder.set_next_reminder() # if it repeats
-                reminder.delete()
-                conv.set_active()
-                conv.set_context(conversation.CTX_REMINDED, reminder)
-            except Exception as e:
-                reminder.increment_error()
-                if str(e) == "no conversations matched \"{}\"".format(reminder.conv_id):
-                    # reminderbot has been removed from the channel. Known error, no need to report
-                    continue
-                sentry_sdk.capture_exception()
+def reminder_sent(reminder, conv, log=False):
+    with database.unit_of_work(reminder.db):
+        if log:
+            reminder.log_sent()
+        if not reminder.set_next_reminder():
+            reminder.delete()
+        conv.set_active()
+        conv.set_context(conversation.CTX_REMINDED, reminder)
 
+async def send_reminder(bot, config, reminder):
+    with sentry_sdk.push_scope() as scope:
+        scope.user = {"username": reminder.username}
+        scope.set_tag("conv_id", reminder.conv_id)
+        try:
+            if reminder.is_stale():
+                # Missed more than once (e.g. while the bot was down, or behind in catching up):
+                # send it once, for the latest of them, and then it moves on to its next occurrence.
+                await database.run(reminder.collapse_missed)
+                metrics.incr("reminders.collapsed_stale")
+            conv = await database.run(Conversation.lookup, reminder.conv_id, config.db)
+            await keybase.send(bot, conv.id, reminder.reminder_text())
+            print("sent a reminder for", reminder.reminder_time)
+            metrics.observe("reminders.lateness_seconds",
+                    (util.now_utc() - reminder.reminder_time).total_seconds())
+            await database.run(reminder_sent, reminder, conv, config.log_sent_reminders)
+        except Exception as e:
+            # reminderbot has been removed from the channel (or can't write to it). Known error, no
+            # need to report or retry
+            removed = keybase.is_permanent_error(e)
+            await database.run(reminder.send_failed, str(e), ERROR_LIMIT, removed)
+            metrics.incr("reminders.dead" if reminder.deleted else "reminders.retried")
+            if removed:
+                return
+            sentry_sdk.capture_exception()
+
+# Sends the due reminders, up to config.send_concurrency at a time. Reminders for the same
+# conversation go out one after another, in order.
+async def send_reminder_page(bot, config, page):
+    by_conv = {}
+    for reminder in page:
+        by_conv.setdefault(reminder.conv_id, []).append(reminder)
+    limit = asyncio.Semaphore(config.send_concurrency)
+
+    async def send_conv(conv_reminders):
+        for reminder in conv_reminders:
+            async with limit:
+                await send_reminder(bot, config, reminder)
+
+    await asyncio.gather(*(send_conv(rs) for rs in by_conv.values()))
+
+# Sends every due reminder, oldest first. A backlog (e.g. after the bot was down) is worked
+# through a page at a time at no more than config.catchup_rate reminders per second.
+# Returns how many reminders were due.
+async def send_reminders(bot, config):
+    total = 0
+    last = None
+    while True:
+        page = await database.run(reminders.get_due_reminders, config.db, ERROR_LIMIT, last,
+                reminders.DUE_LIMIT)
+        if page:
+            # Reminders that failed are still due, so page on from where this one ended.
+            last = page[-1].page_key()
+        start = time.monotonic()
+        await send_reminder_page(bot, config, page)
+        total += len(page)
+        if len(page) < reminders.DUE_LIMIT:
+            return total
+        metrics.incr("reminders.catchup_pages")
+        await asyncio.sleep(len(page) / config.catchup_rate - (time.monotonic() - start))
+
+# Where the last vacuum of each db stopped, when it ran out of rows or time before the end.
+_vacuum_cursor = {}
+
+# Deletes soft-deleted reminders that their conversation no longer refers to, a batch at a time,
+# stopping after config.vacuum_max_rows or config.vacuum_max_seconds. The next call carries on
+# from there. Returns how many were deleted.
 def vacuum_old_reminders(config):
-    with sqlite3.connect(config.db) as c:
-        cur = c.cursor()
-        cur.execute('''DELETE FROM reminders WHERE rowid IN (
-            SELECT reminders.rowid FROM reminders
-            INNER JOIN conversations ON reminders.conv_id = conversations.id
-            WHERE conversations.reminder_rowid != reminders.rowid
-            AND reminders.deleted = 1
-        )''')
-        rows = cur.rowcount
-        if rows > 0:
-            print("deleted", rows, "old reminders")
+    start = time.monotonic()
+    after = _vacuum_cursor.pop(config.db, 0)
+    rows = 0
+    while True:
+        if rows >= config.vacuum_max_rows or time.monotonic() - start >= config.vacuum_max_seconds:
+            _vacuum_cursor[config.db] = after
+            break
+        limit = min(config.vacuum_batch, config.vacuum_max_rows - rows)
+        with database.connect(config.db) as c:
+            batch = c.execute('''SELECT reminders.rowid, conversations.reminder_rowid != reminders.rowid
+                FROM reminders LEFT JOIN conversations ON reminders.conv_id = conversations.id
+                WHERE reminders.deleted = 1 AND reminders.rowid > ?
+                ORDER BY reminders.rowid LIMIT ?''', (after, limit)).fetchall()
+            # the != is NULL for reminders of unknown conversations, those are kept
+            old = [(rowid,) for rowid, is_old in batch if is_old == 1]
+            c.executemany('DELETE FROM reminders WHERE rowid=?', old)
+        metrics.incr("vacuum.scanned", len(batch))
+        rows += len(old)
+        if len(batch) < limit:
+            metrics.incr("vacuum.passes")
+            break
+        after = batch[-1][0]
+    metrics.incr("vacuum.deleted", rows)
+    metrics.observe("vacuum.seconds", time.monotonic() - start)
+    if rows > 0:
+        print("deleted", rows, "old reminders")
     return rows
 
 class Config(object):
-    def __init__(self, db, username, owner, debug_team=None, debug_topic=None, autosend_logs=False, sentry_dsn=None):
+    def __init__(self, db, username, owner, debug_team=None, debug_topic=None, autosend_logs=False, sentry_dsn=None,
+            send_concurrency=8, metrics_interval=300, catchup_rate=100,
+            log_sent_reminders=False, vacuum_interval=60, vacuum_batch=500, vacuum_max_rows=10000,
+            vacuum_max_seconds=0.5):
         self.db = db
         self.username = username
         self.owner = owner
@@ -316,6 +457,14 @@ class Config(object):
         self.debug_topic = debug_topic
         self.autosend_logs = autosend_logs
         self.sentry_dsn = sentry_dsn
+        self.send_concurrency = send_concurrency # reminders being sent at once
+        self.metrics_interval = metrics_interval # seconds between metrics reports
+        self.catchup_rate = catchup_rate # most reminders sent per second when behind
+        self.log_sent_reminders = log_sent_reminders # keep a row in sent_reminders per reminder sent
+        self.vacuum_interval = vacuum_interval # seconds between deleting old reminders
+        self.vacuum_batch = vacuum_batch # old reminders looked at per query
+        self.vacuum_max_rows = vacuum_max_rows # most old reminders deleted per run
+        self.vacuum_max_seconds = vacuum_max_seconds # longest a run keeps going
 
     @classmethod
     def fromFile(cls, configFile):
@@ -328,12 +477,23 @@ class Config(object):
         debug_topic = config['keybase'].get('debug_topic', None)
         autosend_logs = config['keybase'].getboolean('autosend_logs', False)
         sentry_dsn = config['sentry'].get('dsn', None)
-        return Config(db, username, owner, debug_team, debug_topic, autosend_logs, sentry_dsn)
+        send_concurrency = config.getint('reminders', 'send_concurrency', fallback=8)
+        metrics_interval = config.getint('reminders', 'metrics_interval', fallback=300)
+        catchup_rate = config.getint('reminders', 'catchup_rate', fallback=100)
+        log_sent_reminders = config.getboolean('reminders', 'log_sent_reminders', fallback=False)
+        vacuum_interval = config.getint('reminders', 'vacuum_interval', fallback=60)
+        vacuum_batch = config.getint('reminders', 'vacuum_batch', fallback=500)
+        vacuum_max_rows = config.getint('reminders', 'vacuum_max_rows', fallback=10000)
+        vacuum_max_seconds = config.getfloat('reminders', 'vacuum_max_seconds', fallback=0.5)
+        return Config(db, username, owner, debug_team, debug_topic, autosend_logs, sentry_dsn,
+                send_concurrency, metrics_interval, catchup_rate, log_sent_reminders,
+                vacuum_interval, vacuum_batch, vacuum_max_rows, vacuum_max_seconds)
 
 def setup(config):
     if config.sentry_dsn:
         sentry_sdk.init(config.sentry_dsn)
     database.setup(config.db)
+    conversation.load_strong_contexts(config.db)
     import nltk
     libs = ('punkt', 'averaged_perceptron_tagger', 'universal_tagset')
     for lib in libs:
@@ -378,24 +538,38 @@ if __name__ == "__main__":
         await advertise_commands(bot)
         await bot.start({})
 
+    reminder_scheduler = scheduler.start(config.db, ERROR_LIMIT)
+
     async def send_reminder_loop():
+        await database.run(reminder_scheduler.load)
         while running:
             sys.stdout.flush()
             sys.stderr.flush()
 
             try:
+                await reminder_scheduler.wait()
+                if not running:
+                    break
                 await send_reminders(bot, config)
-                vacuum_old_reminders(config)
             except:
                 sentry_sdk.capture_exception()
+                await asyncio.sleep(1)
 
-            if not running:
-                break
+    async def vacuum_loop():
+        while running:
+            await asyncio.sleep(config.vacuum_interval)
+            try:
+                await database.run(vacuum_old_reminders, config)
+            except:
+                sentry_sdk.capture_exception()
 
-            await asyncio.sleep(1)
+    async def metrics_loop():
+        while running:
+            await asyncio.sleep(config.metrics_interval)
+            metrics.report()
 
     loop.run_until_complete(
-        asyncio.gather(listen_loop(), send_reminder_loop()),
+        asyncio.gather(listen_loop(), send_reminder_loop(), vacuum_loop(), metrics_loop()),
     )
 
     print("ReminderBot shut down gracefully.")
@@ -1,8 +1,10 @@
-import datetime, pytz, sqlite3, unittest
+import asyncio, datetime, os, pytz, sqlite3, tempfile, threading, time, unittest
 import mock
 from mock import patch
+from pykeybasebot.kbevent import EventType, KbEvent
+from pykeybasebot.types import chat1
 
-import bot, conversation, keybase, parse
+import bot, conversation, database, keybase, metrics, parse, reminders, scheduler, timezones, util
 from conversation import Conversation
 from user import User
 from reminders import get_due_reminders, Reminder
@@ -49,6 +51,23 @@ class TestBot(unittest.IsolatedAsyncioTestCase):
         mockNow.return_value = mockNow.return_value + datetime.timedelta(minutes=1)
         await self.message_test('not parsable', bot.UNKNOWN, mockKeybaseSend)
 
+    async def test_parse_off_database_thread(self, mockNow, mockRandom, mockKeybaseSend):
+        threads = []
+        def parse_message(*args):
+            threads.append(threading.current_thread().name)
+            return real_parse(*args)
+        real_parse = parse.parse_message
+        conv = Conversation.lookup_or_json(TEST_CONV_ID, TEST_CONV_JSON, DB)
+        texts = ["remind me to foo", "in 5 minutes"]
+        with patch('parse.parse_message', side_effect=parse_message):
+            # two at once in the same conversation still go in order
+            await asyncio.gather(*(bot.process_message(self.bot, self.config,
+                keybase.Message.inject(text, TEST_USER, TEST_CONV_ID, TEST_CHANNEL, DB), conv)
+                for text in texts))
+        assert len(threads) == 2 and all(name.startswith('parse') for name in threads)
+        # the second was read as the answer to the first
+        mockKeybaseSend.assert_called_with(self.bot, TEST_CONV_ID, "Ok! I'll remind you to foo at 9:07 PM")
+
     async def reminder_test(self, text, reminder, whentext, fullwhen, timedelta, mockNow, mockKeybaseSend):
         await self.message_test(text,
                 "Ok! I'll remind you to " + reminder + " " + whentext, mockKeybaseSend)
@@ -144,6 +163,14 @@ class TestBot(unittest.IsolatedAsyncioTestCase):
         await self.message_test("remind me to paint dan's fence at 14:00 am",
             "When do you want to be reminded?", mockKeybaseSend)
 
+    async def test_longest_when_first(self, mockNow, mockRandom, mockKeybaseSend):
+        with patch('parse.try_parse_when', wraps=parse.try_parse_when) as mockParseWhen:
+            await self.message_test("remind me to call mom on the phone tomorrow at 5pm",
+                    "Ok! I'll remind you to call mom on the phone on Monday at 5:00 PM", mockKeybaseSend)
+        # "on the phone tomorrow at 5pm" doesn't parse, "tomorrow at 5pm" does, "at 5pm" isn't tried
+        assert [c[0][0] for c in mockParseWhen.call_args_list] == \
+                ["on the phone tomorrow at 5pm", "tomorrow at 5pm"]
+
     async def test_set_reminder_pre_when(self, mockNow, mockRandom, mockKeybaseSend):
         await self.reminder_test(
                 "remind me tuesday 8am to eat a quiche",
@@ -232,6 +259,21 @@ class TestBot(unittest.IsolatedAsyncioTestCase):
         await self.message_test("list my reminders", "Here are your upcoming reminders:\n\n"
                 "1. foo - on Monday April 9 2018 at 9:00 AM\n", mockKeybaseSend)
 
+    async def test_set_timezone_city(self, mockNow, mockRandom, mockKeybaseSend):
+        await self.message_test("remind me to foo tomorrow at 9am",
+                "Ok! I'll remind you to foo at 9:00 AM", mockKeybaseSend)
+        await self.message_test("my timezone is new york", bot.ACK, mockKeybaseSend)
+        assert User.lookup(TEST_USER, DB).timezone == "America/New_York"
+        await self.message_test("set my timezone to narnia", bot.HELP_TZ, mockKeybaseSend)
+
+    async def test_crash_rolls_back(self, mockNow, mockRandom, mockKeybaseSend):
+        with patch.object(Conversation, 'set_context', side_effect=RuntimeError("crash")):
+            with self.assertRaises(RuntimeError):
+                await self.send_message("remind me to foo tomorrow", mockKeybaseSend)
+        # nothing was sent for the crashed message, and the reminder wasn't stored
+        assert not mockKeybaseSend.called
+        await self.message_test("list", bot.NO_REMINDERS, mockKeybaseSend)
+
     async def test_parse_source(self, mockNow, mockRandom, mockKeybaseSend):
         await self.message_test(" What are you made of", bot.SOURCE, mockKeybaseSend)
         await self.message_test(" What are you made of??", bot.SOURCE, mockKeybaseSend)
@@ -341,6 +383,32 @@ class TestBot(unittest.IsolatedAsyncioTestCase):
         rows = bot.vacuum_old_reminders(self.config)
         assert rows == 1
 
+    async def test_vacuum_batches(self, mockNow, mockRandom, mockKeybaseSend):
+        self.config.vacuum_batch = 2
+        self.config.vacuum_max_rows = 3
+        conv = Conversation.lookup_or_json(TEST_CONV_ID, TEST_CONV_JSON, DB)
+        while bot.vacuum_old_reminders(self.config):
+            pass
+        for i in range(5):
+            reminder = Reminder("foo", NOW_UTC, None, TEST_USER, TEST_CONV_ID, DB)
+            reminder.store()
+            reminder.delete()
+        # the last one is kept, it's the conversation's reminder
+        conv.set_context(conversation.CTX_DELETED, reminder)
+        assert bot.vacuum_old_reminders(self.config) == 3
+        assert bot.vacuum_old_reminders(self.config) == 1
+        assert bot.vacuum_old_reminders(self.config) == 0
+        assert Reminder.lookup(reminder.id, DB).deleted
+
+    async def test_reminders_not_read_unless_deleting(self, mockNow, mockRandom, mockKeybaseSend):
+        await self.send_message("remind me to foo tomorrow", mockKeybaseSend)
+        with patch('conversation.UpcomingReminders.__iter__') as mockIter, \
+                patch('conversation.UpcomingReminders.at') as mockAt:
+            for text in ("hi", "remind me to bar tomorrow", "set my timezone to US/Pacific"):
+                await self.send_message(text, mockKeybaseSend)
+            assert not mockIter.called
+            assert not mockAt.called
+
     async def delete_test(self, delete_text, reminder_text, mockKeybaseSend):
         await self.send_message("remind me to do something else on Tuesday", mockKeybaseSend)
         await self.send_message(reminder_text, mockKeybaseSend)
@@ -375,6 +443,26 @@ class TestBot(unittest.IsolatedAsyncioTestCase):
         list_output = "Here are your upcoming reminders:\n\n1. foo - on Monday April 9 2018 at 9:02 PM\n"
         await self.message_test("list", list_output, mockKeybaseSend)
 
+    @patch('bot.LIST_PAGE_LENGTH', 200)
+    async def test_list_pages(self, mockNow, mockRandom, mockKeybaseSend):
+        await self.send_message("remind me to foo tomorrow", mockKeybaseSend)
+        for i in range(9):
+            Reminder("foo " + str(i), NOW_UTC + datetime.timedelta(days=2, hours=i), None,
+                    TEST_USER, TEST_CONV_ID, DB).store()
+        mockKeybaseSend.reset_mock()
+        with patch('reminders.Reminder.get_user', autospec=True,
+                side_effect=lambda r: User.lookup(r.username, r.db)) as mockGetUser:
+            await self.send_message("list", mockKeybaseSend)
+        # one lookup for the whole list
+        assert mockGetUser.call_count == 1
+        pages = [c[0][2] for c in mockKeybaseSend.call_args_list]
+        assert len(pages) > 1
+        assert all(len(page) <= 200 for page in pages)
+        lines = "".join(pages)[len(bot.LIST_INTRO):].splitlines()
+        assert len(lines) == 10
+        assert lines[0] == "1. foo - on Monday April 9 2018 at 9:02 PM"
+        assert lines[9] == "10. foo 8 - on Wednesday April 11 2018 at 5:02 AM"
+
     async def test_repeating(self, mockNow, mockRandom, mockKeybaseSend):
         await self.reminder_test(
                 "remind me every tuesday 8am to eat a quiche",
@@ -449,6 +537,28 @@ class TestBot(unittest.IsolatedAsyncioTestCase):
         list_output = "Here are your upcoming reminders:\n\n1. eat a quiche - every week on Tuesday at 8:00 AM\n"
         await self.message_test("list", list_output, mockKeybaseSend)
 
+    async def test_repeating_in_place(self, mockNow, mockRandom, mockKeybaseSend):
+        self.config.log_sent_reminders = True
+        await self.message_test("remind me every 6 hours to eat a quiche",
+                "Ok! I'll remind you to eat a quiche every 6 hours", mockKeybaseSend)
+        id = Conversation.lookup(TEST_CONV_ID, DB).reminder_id
+        first = Reminder.lookup(id, DB).reminder_time
+        with database.connect(DB) as c:
+            rows = c.execute('select count(*) from reminders').fetchone()[0]
+        for i in range(1, 4):
+            mockNow.return_value = NOW_UTC + datetime.timedelta(hours=6 * i)
+            await bot.send_reminders(self.bot, self.config)
+            mockKeybaseSend.assert_called_with(self.bot, TEST_CONV_ID, ":bell: *Reminder:* eat a quiche")
+        # the same row was moved on, no new ones were added
+        r = Reminder.lookup(id, DB)
+        assert r.reminder_time == first + datetime.timedelta(hours=18)
+        assert not r.deleted
+        with database.connect(DB) as c:
+            assert c.execute('select count(*) from reminders').fetchone()[0] == rows
+            sent = c.execute('select reminder_time from sent_reminders where reminder_rowid=?', (id,)).fetchall()
+            c.execute('delete from sent_reminders')
+        assert [row[0] for row in sent] == [util.to_ts(first + datetime.timedelta(hours=6 * i)) for i in range(3)]
+
     async def test_repeating_weekday(self, mockNow, mockRandom, mockKeybaseSend):
         await self.reminder_test(
                 "remind me every weekday at 6pm to eat a quiche",
@@ -539,26 +649,644 @@ class TestBot(unittest.IsolatedAsyncioTestCase):
         await bot.send_reminders(self.bot, self.config)
         assert not mockKeybaseSend.called
 
-    # Make sure it doesn't try to send a reminder after more than 10 failures
+    async def test_send_reminders_concurrently(self, mockNow, mockRandom, mockKeybaseSend):
+        Conversation.lookup_or_json(TEST_CONV_ID, TEST_CONV_JSON, DB)
+        other_conv_id = "0002"
+        other_conv = Conversation.lookup_or_json(other_conv_id,
+                {"id": other_conv_id, "channel": TEST_CHANNEL_JSON}, DB)
+        for conv_id, body, minutes in ((TEST_CONV_ID, "second", 2), (TEST_CONV_ID, "first", 1),
+                (other_conv_id, "other", 3)):
+            Reminder(body, NOW_UTC + datetime.timedelta(minutes=minutes), None, TEST_USER, conv_id, DB).store()
+        sent = []
+        async def send(bot, conv_id, msg):
+            if msg.endswith("first"):
+                await asyncio.sleep(0.05)
+            sent.append(msg)
+        mockKeybaseSend.side_effect = send
+        mockNow.return_value = NOW_UTC + datetime.timedelta(minutes=5)
+        await bot.send_reminders(self.bot, self.config)
+        other_conv.delete()
+        # the slow conversation didn't hold up the other one, and kept its own order
+        assert sent == [":bell: *Reminder:* other", ":bell: *Reminder:* first", ":bell: *Reminder:* second"]
+        assert metrics.timing("reminders.lateness_seconds").max >= 4 * 60
+
+    @patch('reminders.DUE_LIMIT', 3)
+    async def test_send_reminders_backlog(self, mockNow, mockRandom, mockKeybaseSend):
+        Conversation.lookup_or_json(TEST_CONV_ID, TEST_CONV_JSON, DB)
+        for minutes in (5, 1, 7, 3, 2, 6, 4):
+            Reminder(str(minutes), NOW_UTC + datetime.timedelta(minutes=minutes), None,
+                    TEST_USER, TEST_CONV_ID, DB).store()
+        sent = []
+        async def send(bot, conv_id, msg):
+            if msg.endswith("2"):
+                raise Exception("failure to send reminder")
+            sent.append(msg)
+        mockKeybaseSend.side_effect = send
+        mockNow.return_value = NOW_UTC + datetime.timedelta(hours=1)
+        self.config.catchup_rate = 1000
+        due = await bot.send_reminders(self.bot, self.config)
+        # all of them, oldest first, and the failing one didn't stop the rest
+        assert due == 7
+        assert sent == [":bell: *Reminder:* " + str(m) for m in (1, 3, 4, 5, 6, 7)]
+
+    async def test_collapse_stale_repeats(self, mockNow, mockRandom, mockKeybaseSend):
+        await self.message_test("remind me every 6 hours to eat a quiche",
+                "Ok! I'll remind you to eat a quiche every 6 hours", mockKeybaseSend)
+        mockKeybaseSend.reset_mock()
+        id = Conversation.lookup(TEST_CONV_ID, DB).reminder_id
+        metrics.reset()
+        mockNow.return_value = NOW_UTC + datetime.timedelta(days=2, hours=1)
+        await bot.send_reminders(self.bot, self.config)
+        # sent once for the 8 it missed, measured from the latest
+        mockKeybaseSend.assert_called_once_with(self.bot, TEST_CONV_ID, ":bell: *Reminder:* eat a quiche")
+        assert metrics.counter("reminders.collapsed_stale") == 1
+        assert metrics.timing("reminders.lateness_seconds").max == 60 * 60
+        assert Reminder.lookup(id, DB).reminder_time == NOW_UTC + datetime.timedelta(days=2, hours=6)
+
+    async def test_every_minute_sent_when_late(self, mockNow, mockRandom, mockKeybaseSend):
+        await self.message_test("remind me every minute to stretch",
+                "Ok! I'll remind you to stretch every minute", mockKeybaseSend)
+        mockKeybaseSend.reset_mock()
+        mockNow.return_value = NOW_UTC + datetime.timedelta(minutes=3, seconds=30)
+        await bot.send_reminders(self.bot, self.config)
+        mockKeybaseSend.assert_called_once_with(self.bot, TEST_CONV_ID, ":bell: *Reminder:* stretch")
+
+    async def test_collapse_failure_is_a_send_failure(self, mockNow, mockRandom, mockKeybaseSend):
+        await self.message_test("remind me every hour to stand up",
+                "Ok! I'll remind you to stand up every hour", mockKeybaseSend)
+        mockKeybaseSend.reset_mock()
+        id = Conversation.lookup(TEST_CONV_ID, DB).reminder_id
+        Reminder("later", NOW_UTC + datetime.timedelta(hours=2), None, TEST_USER, TEST_CONV_ID, DB).store()
+        mockNow.return_value = NOW_UTC + datetime.timedelta(hours=5)
+        with patch.object(Reminder, 'collapse_missed', side_effect=sqlite3.OperationalError("locked")):
+            await bot.send_reminders(self.bot, self.config)
+        # retried later, and the rest of the page still went out
+        assert Reminder.lookup(id, DB).errors == 1
+        mockKeybaseSend.assert_called_once_with(self.bot, TEST_CONV_ID, ":bell: *Reminder:* later")
+
+    # Failed sends are retried with backoff, and after more than 10 failures the reminder is
+    # moved to the dead letter table.
     async def test_reminder_errors(self, mockNow, mockRandom, mockKeybaseSend):
         await self.message_test(
             "remind me to foo tomorrow", "Ok! I'll remind you to foo on Monday at 9:02 PM",
             mockKeybaseSend,
         )
+        id = Conversation.lookup(TEST_CONV_ID, DB).reminder_id
         mockNow.return_value = mockNow.return_value + datetime.timedelta(days=1)
         mockKeybaseSend.side_effect = Exception("failure to send reminder")
+        mockKeybaseSend.reset_mock()
         await bot.send_reminders(self.bot, self.config)
-        rs = get_due_reminders(DB, error_limit=0)
-        assert len(rs) == 0
-        rs = get_due_reminders(DB, error_limit=1)
+        r = Reminder.lookup(id, DB)
+        assert r.errors == 1
+        # not retried until the backoff is over
+        assert len(get_due_reminders(DB, error_limit=10)) == 0
+        mockNow.return_value = r.next_attempt_time
+        rs = get_due_reminders(DB, error_limit=10)
         assert len(rs) == 1
-        id = rs[0].id
+        # the backoff grows
+        await bot.send_reminders(self.bot, self.config)
+        r2 = Reminder.lookup(id, DB)
+        assert r2.errors == 2
+        base = datetime.timedelta(seconds=reminders.RETRY_BASE_SECONDS)
+        assert r.next_attempt_time - r.reminder_time <= base
+        assert r2.next_attempt_time - mockNow.return_value >= base
         # try more than error_limit (10) times
         for i in range(15):
+            mockNow.return_value = mockNow.return_value + datetime.timedelta(hours=2)
             await bot.send_reminders(self.bot, self.config)
 
+        assert mockKeybaseSend.call_count == 11
         r = Reminder.lookup(id, DB)
         assert r.errors == 11
+        assert r.deleted
+        dead = [row for row in reminders.get_dead_reminders(DB) if row["reminder_rowid"] == id]
+        assert len(dead) == 1
+        assert dead[0]["error"] == "failure to send reminder"
+
+        # replaying it sends it again
+        reminders.replay_dead_reminder(dead[0]["rowid"], DB)
+        mockKeybaseSend.side_effect = None
+        await bot.send_reminders(self.bot, self.config)
+        mockKeybaseSend.assert_called_with(self.bot, TEST_CONV_ID, ":bell: *Reminder:* foo")
+        assert not any(row["reminder_rowid"] == id for row in reminders.get_dead_reminders(DB))
+
+
+class TestDatabase(unittest.TestCase):
+
+    def setUp(self):
+        database.setup(DB)
+
+    def test_connection_is_reused(self):
+        with database.connect(DB) as c1:
+            pass
+        with database.connect(DB) as c2:
+            pass
+        assert c1 is c2
+
+    def test_wal(self):
+        with database.connect(DB) as c:
+            mode = c.execute('pragma journal_mode').fetchone()[0]
+        assert mode == 'wal'
+
+    def test_run_off_event_loop(self):
+        async def run():
+            return await database.run(threading.get_ident)
+        assert asyncio.run(run()) != threading.get_ident()
+
+    def test_rollback_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with database.connect(DB) as c:
+                c.execute("insert into users (username, settings) values ('__rollback__', '{}')")
+                raise RuntimeError()
+        with database.connect(DB) as c:
+            row = c.execute("select * from users where username='__rollback__'").fetchone()
+        assert row is None
+
+    def test_user_settings_migration(self):
+        with tempfile.TemporaryDirectory() as d:
+            db = os.path.join(d, 'old.db')
+            with sqlite3.connect(db) as c:
+                database.initial_tables(c)
+                c.execute('pragma user_version = 1')
+                c.execute('''insert into users (username, settings)
+                    values ('__old__', '{"timezone": "US/Pacific", "has_seen_help": true}')''')
+            database.setup(db)
+            user = User.lookup('__old__', db)
+            assert user.timezone == 'US/Pacific'
+            assert user.has_seen_help
+            database.close_all()
+
+    def test_user_is_cached(self):
+        user = User.lookup(TEST_USER, DB)
+        with patch('database.connect') as mockConnect:
+            assert User.lookup(TEST_USER, DB) is user
+            assert not mockConnect.called
+        with self.assertRaises(RuntimeError):
+            with database.unit_of_work(DB):
+                user.set_seen_help()
+                raise RuntimeError()
+        assert not User.lookup(TEST_USER, DB).has_seen_help
+        user.delete()
+
+    def test_live_reminder_indexes(self):
+        def plan(sql):
+            with database.connect(DB) as c:
+                return " ".join(row[3] for row in c.execute('EXPLAIN QUERY PLAN ' + sql, (None,) * sql.count('?')))
+        assert 'idx_reminder_due' in plan(reminders.DUE_QUERY)
+        assert 'COVERING INDEX idx_reminder_conv_live' in plan(conversation.UpcomingReminders.QUERY)
+        assert 'COVERING INDEX idx_reminder_conv_live' in plan(
+                conversation.UpcomingReminders.QUERY + ' limit 1 offset ?')
+
+    def test_explain_finds_queries(self):
+        import explain
+        queries = [" ".join(sql.split()) for _, _, sql in explain.find_queries(['conversation.py'])]
+        assert "update conversations set context=?, reminder_rowid=? where id=?" in queries
+        assert " ".join(conversation.UpcomingReminders.QUERY.split()) in queries
+
+class TestConversationCache(unittest.TestCase):
+
+    def setUp(self):
+        database.setup(DB)
+        metrics.reset()
+
+    def tearDown(self):
+        Conversation.lookup(TEST_CONV_ID, DB).delete()
+
+    def test_lookup_is_cached(self):
+        conv = Conversation.lookup_or_json(TEST_CONV_ID, TEST_CONV_JSON, DB)
+        with patch('database.connect') as mockConnect:
+            assert Conversation.lookup(TEST_CONV_ID, DB) is conv
+            assert not mockConnect.called
+        assert metrics.counter("conversations.cache.hits") == 1
+
+    def test_rollback_uncaches(self):
+        conv = Conversation.lookup_or_json(TEST_CONV_ID, TEST_CONV_JSON, DB)
+        conv.set_debug(False)
+        with self.assertRaises(RuntimeError):
+            with database.unit_of_work(DB):
+                conv.set_debug(True)
+                raise RuntimeError()
+        fresh = Conversation.lookup(TEST_CONV_ID, DB)
+        assert fresh is not conv
+        assert not fresh.debug
+
+    def test_eviction(self):
+        with patch.object(conversation._cache, 'size', 1):
+            conv = Conversation.lookup_or_json(TEST_CONV_ID, TEST_CONV_JSON, DB)
+            other = Conversation.lookup_or_json("0002", TEST_CONV_JSON, DB)
+            assert metrics.counter("conversations.cache.evictions") == 1
+            assert Conversation.lookup(TEST_CONV_ID, DB) is not conv
+            other.delete()
+
+def msg_summary(text, conv_id, sender=TEST_USER, type_name="text", members_type="team", bot_username=None):
+    return chat1.MsgSummary.from_dict({
+        "id": 1, "conv_id": conv_id, "sent_at": 0, "sent_at_ms": 0, "unread": True,
+        "channel": {"name": "someteam", "members_type": members_type},
+        "sender": {"uid": "", "device_id": "", "username": sender},
+        "bot_info": {"bot_uid": "", "bot_username": bot_username} if bot_username else None,
+        "content": {"type": type_name, "text": {"body": text}}})
+
+class TestMessage(unittest.TestCase):
+
+    def test_from_msgsummary(self):
+        message = keybase.Message.from_msgsummary(msg_summary("hi", "0002", bot_username=TEST_BOT), DB)
+        assert (message.text, message.author, message.conv_id, message.channel_name,
+                message.channel_members_type, message.bot_username) == \
+                ("hi", TEST_USER, "0002", "someteam", "team", TEST_BOT)
+        assert not message.is_private_channel()
+        assert keybase.Message.from_msgsummary(msg_summary("hi", "0002"), DB).bot_username is None
+        assert not hasattr(message, '__dict__')
+
+class FakeChat(object):
+    def __init__(self, send):
+        self.send = send
+
+class FakeBot(object):
+    def __init__(self, send):
+        self.chat = FakeChat(send)
+
+@patch('keybase.SEND_RETRY_BASE_SECONDS', 0.001)
+class TestSendQueue(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    async def test_order_per_conversation(self):
+        sent = []
+        async def send(conv_id, msg):
+            if msg == "first":
+                await asyncio.sleep(0.05)
+            sent.append(msg)
+        bot = FakeBot(send)
+        futures = [keybase.submit(bot, conv_id, msg) for conv_id, msg in
+                (("a", "first"), ("a", "second"), ("b", "other"))]
+        await asyncio.gather(*futures)
+        # the slow conversation didn't hold up the other one, and kept its own order
+        assert sent == ["other", "first", "second"]
+        assert metrics.timing("send.seconds").count == 3
+        assert keybase.send_queue().depth() == 0
+
+    async def test_concurrency_limit(self):
+        sending = []
+        most = 0
+        async def send(conv_id, msg):
+            nonlocal most
+            sending.append(conv_id)
+            most = max(most, len(sending))
+            await asyncio.sleep(0.01)
+            sending.remove(conv_id)
+        queue = keybase.SendQueue(concurrency=2)
+        await asyncio.gather(*(queue.submit(FakeBot(send), str(i), "hi") for i in range(6)))
+        assert most == 2
+
+    async def test_debug_channel(self):
+        sent = []
+        async def send(channel, msg):
+            sent.append((channel.name, channel.topic_name, msg))
+        config = bot.Config(DB, TEST_BOT, TEST_OWNER, debug_team="debugteam", debug_topic="errors")
+        outbox = keybase.Outbox(FakeBot(send), config)
+        outbox.debug(mock.Mock(debug=True), "first")
+        outbox.debug(mock.Mock(debug=True), "second")
+        await outbox.flush()
+        assert sent == [("debugteam", "errors", "first"), ("debugteam", "errors", "second")]
+
+    async def test_retries(self):
+        attempts = []
+        async def send(conv_id, msg):
+            attempts.append(msg)
+            if len(attempts) < 3:
+                raise Exception("timeout")
+        await keybase.send(FakeBot(send), "a", "hi")
+        assert len(attempts) == 3
+        assert metrics.counter("send.retries") == 2
+
+    async def test_gives_up(self):
+        send = mock.AsyncMock(side_effect=Exception("timeout"))
+        with self.assertRaises(Exception):
+            await keybase.send(FakeBot(send), "a", "hi")
+        assert send.call_count == keybase.SEND_RETRIES + 1
+        assert metrics.counter("send.failed") == 1
+
+    async def test_permanent_error(self):
+        send = mock.AsyncMock(side_effect=Exception('no conversations matched "a"'))
+        failed = keybase.submit(FakeBot(send), "a", "hi")
+        with self.assertRaises(Exception):
+            await failed
+        assert send.call_count == 1
+        assert metrics.counter("send.permanent_errors") == 1
+
+class TestPrefilter(unittest.IsolatedAsyncioTestCase):
+
+    CONV_ID = "prefilter"
+
+    def setUp(self):
+        database.setup(DB)
+        metrics.reset()
+        self.config = bot.Config(DB, TEST_BOT, TEST_OWNER)
+        self.conv = Conversation.lookup_or_json(self.CONV_ID, TEST_CONV_JSON, DB)
+        conversation.load_strong_contexts(DB)
+
+    def tearDown(self):
+        conversation._strong_contexts.pop(DB, None)
+        self.conv.delete()
+        User.lookup(TEST_USER, DB).delete()
+
+    def event(self, text, sender=TEST_USER, type_name="text", members_type="team"):
+        return KbEvent(type=EventType.CHAT, msg=msg_summary(text, self.CONV_ID, sender=sender,
+                type_name=type_name, members_type=members_type))
+
+    def test_reasons(self):
+        assert bot.prefilter(self.event("hi all"), self.config) == "not_for_me"
+        assert bot.prefilter(self.event("hi all", type_name="edit"), self.config) == "not_text"
+        assert bot.prefilter(self.event("hi", sender=TEST_BOT), self.config) == "own"
+        assert bot.prefilter(self.event("@" + TEST_BOT + " help"), self.config) is None
+        assert bot.prefilter(self.event("hi", members_type="impteamnative"), self.config) is None
+
+    def test_strong_context(self):
+        reminder = Reminder("foo", None, None, TEST_USER, self.CONV_ID, DB)
+        reminder.store()
+        self.conv.set_context(conversation.CTX_WHEN, reminder)
+        assert bot.prefilter(self.event("tomorrow"), self.config) is None
+        self.conv.set_context(conversation.CTX_NONE)
+        assert bot.prefilter(self.event("tomorrow"), self.config) == "not_for_me"
+
+    def test_unknown_without_strong_contexts(self):
+        conversation._strong_contexts.pop(DB)
+        assert bot.prefilter(self.event("hi all"), self.config) is None
+
+    async def test_dropped_before_db(self):
+        with patch('database.run') as mockRun:
+            await bot.Handler(self.config)(None, self.event("hi all"))
+        assert not mockRun.called
+        assert metrics.counter("events.received") == 1
+        assert metrics.counter("events.dropped.not_for_me") == 1
+
+@patch('nltk.word_tokenize', side_effect=str.split)
+class TestWordIndex(unittest.TestCase):
+
+    CONV_ID = "wordindex"
+
+    def setUp(self):
+        database.setup(DB)
+        self.conv = Conversation.lookup_or_json(self.CONV_ID, TEST_CONV_JSON, DB)
+
+    def tearDown(self):
+        User.lookup(TEST_USER, DB).delete()
+        self.conv.delete()
+
+    def store(self, body, delay=datetime.timedelta(hours=1)):
+        reminder = Reminder(body, util.now_utc() + delay, None, TEST_USER, self.CONV_ID, DB)
+        reminder.store()
+        return reminder
+
+    def test_best_text_match(self, mockTokenize):
+        self.store("call mom")
+        meeting = self.store("go to the meeting meeting")
+        self.store("meeting notes", datetime.timedelta(hours=2))
+        self.store("old meeting meeting meeting", -datetime.timedelta(hours=1))
+        upcoming = self.conv.upcoming_reminders()
+        best, score = upcoming.best_text_match([["meeting"], ["the", "meeting"]])
+        assert best.id == meeting.id
+        assert score == 9
+        assert upcoming.best_text_match([["dentist"]]) == (None, 0)
+
+    def test_kept_up_to_date(self, mockTokenize):
+        first = self.store("first meeting")
+        upcoming = self.conv.upcoming_reminders()
+        assert upcoming.best_text_match([["meeting"]])[0].id == first.id
+        calls = mockTokenize.call_count
+        second = self.store("second meeting meeting")
+        assert upcoming.best_text_match([["meeting"]])[0].id == second.id
+        second.delete()
+        assert upcoming.best_text_match([["meeting"]])[0].id == first.id
+        with self.assertRaises(RuntimeError):
+            with database.unit_of_work(DB):
+                first.delete()
+                raise RuntimeError()
+        first.deleted = False
+        assert upcoming.best_text_match([["meeting"]])[0].id == first.id
+        second.undelete()
+        assert upcoming.best_text_match([["meeting"]])[0].id == second.id
+        # only the new and undeleted bodies were tokenized again
+        assert mockTokenize.call_count == calls + 2
+
+class TestScheduler(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        database.setup(DB)
+        self.scheduler = scheduler.start(DB, error_limit=10)
+
+    def tearDown(self):
+        scheduler.stop(DB)
+        User.lookup(TEST_USER, DB).delete()
+
+    def store(self, delay):
+        reminder = Reminder("foo", util.now_utc() + delay, None, TEST_USER, TEST_CONV_ID, DB)
+        reminder.store()
+        return reminder
+
+    async def test_wakes_when_due(self):
+        self.store(datetime.timedelta(milliseconds=50))
+        start = time.monotonic()
+        await asyncio.wait_for(self.scheduler.wait(), 5)
+        assert 0.04 <= time.monotonic() - start < 1
+        assert self.scheduler.next_ts() is None
+
+    async def test_wakes_early_for_new_reminder(self):
+        self.store(datetime.timedelta(hours=1))
+        waiter = asyncio.ensure_future(self.scheduler.wait())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        self.store(datetime.timedelta(milliseconds=20))
+        await asyncio.wait_for(waiter, 1)
+
+    async def test_changes(self):
+        reminder = self.store(datetime.timedelta(hours=1))
+        assert self.scheduler.next_ts() == util.to_ts(reminder.reminder_time)
+        reminder.delete()
+        assert self.scheduler.next_ts() is None
+        reminder.undelete()
+        assert self.scheduler.next_ts() == util.to_ts(reminder.reminder_time)
+        snooze = util.now_utc() + datetime.timedelta(minutes=10)
+        reminder.snooze_until(snooze)
+        assert self.scheduler.next_ts() == util.to_ts(snooze)
+
+    async def test_rolled_back_changes_are_ignored(self):
+        reminder = self.store(datetime.timedelta(hours=1))
+        with self.assertRaises(RuntimeError):
+            with database.unit_of_work(DB):
+                reminder.delete()
+                raise RuntimeError()
+        assert self.scheduler.next_ts() == util.to_ts(reminder.reminder_time)
+
+class TestTimezones(unittest.TestCase):
+
+    def test_resolve(self):
+        assert timezones.resolve("US/Pacific") == "US/Pacific"
+        assert timezones.resolve("us/pacific") == "US/Pacific"
+        assert timezones.resolve("EST") == "EST"
+        assert timezones.resolve("pst") == "US/Pacific"
+        assert timezones.resolve("Chicago") == "America/Chicago"
+        assert timezones.resolve("sao paulo") == "America/Sao_Paulo"
+        assert timezones.resolve("chica") == "America/Chicago"
+        assert timezones.resolve("narnia") is None
+
+    def test_city_must_be_the_whole_answer(self):
+        assert parse.try_parse_timezone("my timezone is new jersey") == (None, True)
+        assert parse.try_parse_timezone("my timezone is cape town") == (None, True)
+        assert parse.try_parse_timezone("timezone cape") == (None, True)
+        assert parse.try_parse_timezone("my timezone is la paz") == ("America/La_Paz", True)
+        assert parse.try_parse_timezone("set my timezone to new york") == ("America/New_York", True)
+        assert parse.try_parse_timezone("set my timezone to US/Pacific please") == ("US/Pacific", True)
+
+    def test_prefix_must_be_unique(self):
+        assert timezones.resolve("euro") is None # Europe/...
+        assert timezones.resolve("chi") is None # too short
+
+    def test_set_timezone_validates(self):
+        database.setup(DB)
+        user = User.lookup(TEST_USER, DB)
+        try:
+            user.set_timezone("pacific")
+            assert user.timezone == "US/Pacific"
+            with self.assertRaises(ValueError):
+                user.set_timezone("narnia")
+            assert User.lookup(TEST_USER, DB).timezone == "US/Pacific"
+        finally:
+            user.delete()
+
+@patch('util.now_utc', return_value=NOW_UTC)
+class TestParseContext(unittest.TestCase):
+
+    def setUp(self):
+        database.setup(DB)
+        self.conv = Conversation.lookup_or_json(TEST_CONV_ID, TEST_CONV_JSON, DB)
+        self.config = bot.Config(DB, TEST_BOT, TEST_OWNER)
+
+    def tearDown(self):
+        User.lookup(TEST_USER, DB).delete()
+
+    def context(self, text):
+        message = keybase.Message.inject(text, TEST_USER, TEST_CONV_ID, TEST_CHANNEL, DB)
+        return parse.ParseContext(message, self.conv, self.config)
+
+    def test_worked_out_once(self, mockNow):
+        User.lookup(TEST_USER, DB).set_timezone("US/Pacific")
+        ctx = self.context("remind me to foo tomorrow")
+        with patch.object(keybase.Message, 'user', autospec=True, wraps=keybase.Message.user) as mockUser:
+            assert ctx.user is ctx.user
+            assert ctx.tz.zone == "US/Pacific"
+            assert ctx.relative_base == datetime.datetime(2018, 4, 8, 18, 2, 28)
+            assert mockUser.call_count == 1
+        assert mockNow.call_count == 1
+
+    def test_one_user_per_message(self, mockNow):
+        message = keybase.Message.inject("remind me to foo on the 3rd of nevuary at 9",
+                TEST_USER, TEST_CONV_ID, TEST_CHANNEL, DB)
+        with patch.object(keybase.Message, 'user', autospec=True, wraps=keybase.Message.user) as mockUser:
+            msg_type, reminder = parse.parse_message(message, self.conv, self.config)
+        assert msg_type == parse.MSG_REMINDER
+        assert mockUser.call_count == 1
+
+class TestCommonWhen(unittest.TestCase):
+
+    def dateparser(self, when, base, tz):
+        return parse.dateparser.parse(when, settings={'PREFER_DATES_FROM': 'future',
+            'PREFER_DAY_OF_MONTH': 'first', 'TO_TIMEZONE': 'UTC', 'TIMEZONE': tz,
+            'RETURN_AS_TIMEZONE_AWARE': True, 'RELATIVE_BASE': base})
+
+    def test_matches_dateparser(self):
+        base = datetime.datetime(2018, 4, 8, 21, 2, 28, 123456)
+        for when in ("in 5 minutes", "in an hour", "in 3 days", "in 2 weeks", "tomorrow",
+                "tomorrow at 10am", "tomorrow at 10:30 PM", "at 22:30", "at 11pm", "10:30pm",
+                "at 5pm", "on tuesday", "sunday", "tuesday at 8am", "on Friday at 23:15",
+                "next week", "next week at 5pm", "at 10:30pm today", "at 7pm tomorrow"):
+            assert parse.try_parse_common_when(when, base, pytz.timezone('US/Eastern')) == \
+                    self.dateparser(when, base, 'US/Eastern'), when
+
+    def test_falls_back(self):
+        base = datetime.datetime(2018, 4, 8, 21, 2, 28)
+        for when in ("next tuesday", "the 10th", "in 1 month", "at 14:00 am", "at 25:00", "noon"):
+            assert parse.try_parse_common_when(when, base, pytz.timezone('US/Eastern')) is None, when
+
+    def test_too_far(self):
+        base = datetime.datetime(2018, 4, 8, 21, 2, 28)
+        for when in ("in 99999999 days", "in 99999999999999999999 weeks", "in 2930000 days"):
+            assert parse.try_parse_common_when(when, base, pytz.timezone('Pacific/Auckland')) is None, when
+
+    def test_timezone_ahead_of_utc(self):
+        # dateparser puts this tomorrow
+        base = datetime.datetime(2018, 4, 10, 9, 0)
+        when = parse.try_parse_common_when("at 10:30", base, pytz.timezone('Europe/Berlin'))
+        assert when == datetime.datetime(2018, 4, 10, 8, 30, tzinfo=pytz.utc)
+
+
+class TestDateparserCache(unittest.TestCase):
+
+    def setUp(self):
+        parse._dateparser_cache.clear()
+        metrics.reset()
+
+    def parse_at(self, when, base):
+        settings = {'PREFER_DATES_FROM': 'future', 'PREFER_DAY_OF_MONTH': 'first', 'TO_TIMEZONE': 'UTC',
+            'TIMEZONE': 'US/Eastern', 'RETURN_AS_TIMEZONE_AWARE': True, 'RELATIVE_BASE': base}
+        dt = parse.parse_date(when, base, 'US/Eastern', settings)
+        assert dt == parse.dateparser.parse(when, settings=settings), (when, base)
+        return dt
+
+    def test_relative(self):
+        base = datetime.datetime(2018, 4, 8, 21, 2, 28)
+        for minutes in range(5):
+            self.parse_at("in 10  minutes", base + datetime.timedelta(minutes=minutes))
+        assert metrics.counter("dateparser.calls") == 2
+
+    def test_absolute(self):
+        base = datetime.datetime(2018, 4, 8, 21, 2, 28)
+        for minutes in range(5):
+            self.parse_at("the 10th at 9am", base + datetime.timedelta(minutes=minutes))
+        assert metrics.counter("dateparser.calls") == 2
+
+    def test_passed(self):
+        base = datetime.datetime(2018, 4, 8, 21, 2, 28)
+        self.parse_at("today at 9:30pm", base)
+        self.parse_at("today at 9:30pm", base + datetime.timedelta(minutes=1))
+        self.parse_at("today at 9:30pm", base + datetime.timedelta(minutes=2))
+        assert metrics.counter("dateparser.calls") == 2
+        # it's passed, ask dateparser again
+        self.parse_at("today at 9:30pm", base + datetime.timedelta(minutes=30))
+        assert metrics.counter("dateparser.calls") == 3
+
+    def test_base_goes_back(self):
+        base = datetime.datetime(2018, 4, 8, 21, 30)
+        self.parse_at("in 10 minutes", base)
+        self.parse_at("in 10 minutes", base + datetime.timedelta(minutes=1))
+        self.parse_at("in 10 minutes", base - datetime.timedelta(minutes=1))
+        assert metrics.counter("dateparser.calls") == 3
+
+
+class TestRecurrence(unittest.TestCase):
+
+    def step(self, t, interval, nth, after):
+        new = reminders.INTERVALS[interval](t, nth)
+        while new < after:
+            new = reminders.INTERVALS[interval](new, nth)
+        return new
+
+    def test_matches_stepping(self):
+        starts = [NOW_UTC, NOW_UTC.replace(month=1, day=31), NOW_UTC.replace(month=2, day=29, year=2016),
+                NOW_UTC.replace(day=13) - datetime.timedelta(days=1)] # a Thursday
+        gaps = [datetime.timedelta(seconds=-1), datetime.timedelta(0), datetime.timedelta(hours=5),
+                datetime.timedelta(days=30), datetime.timedelta(days=400, minutes=7)]
+        for t in starts:
+            for interval in reminders.INTERVALS:
+                for nth in (1, 2, 3):
+                    for gap in gaps:
+                        after = t + gap
+                        expected = self.step(t, interval, nth, after)
+                        assert reminders.next_occurrence(t, interval, nth, after) == expected, \
+                            (t, interval, nth, after)
+                        # landing exactly on an occurrence
+                        assert reminders.next_occurrence(t, interval, nth, expected) == expected
 
 
 if __name__ == '__main__':
@@ -1,10 +1,10 @@
 # Conversations (channels)
 
-import sqlite3, time
+import json, time
 
 from pykeybasebot.types import chat1
 
-import util
+import database, util, wordindex
 from reminders import Reminder
 
 # Contexts
@@ -16,6 +16,37 @@ CTX_DELETED = 4 # You just deleted a reminder.
 #CTX_TIMEZONE = 2 # What's your timezone?
 # TODO count unknown messages to send a help text
 
+# Conversations that were looked up recently, by (db, id). There's only ever one Conversation
+# object per conversation, and every change is written to the db right away, so a cached one is
+# always up to date.
+CACHE_SIZE = 1000
+_cache = util.LRUCache("conversations.cache", CACHE_SIZE)
+
+# The ids of the conversations in a strong context, by db, so events that aren't for the bot can
+# be dropped without looking their conversation up. Kept up to date once loaded.
+_strong_contexts = {}
+
+def load_strong_contexts(db):
+    with database.connect(db) as c:
+        rows = c.execute('select id from conversations where context=?', (CTX_WHEN,)).fetchall()
+    _strong_contexts[db] = set(row[0] for row in rows)
+
+def in_strong_context(db, id):
+    # True or False, or None if the strong contexts weren't loaded.
+    ids = _strong_contexts.get(db)
+    if ids is None:
+        return None
+    return id in ids
+
+def _strong_context_changed(db, id, strong):
+    ids = _strong_contexts.get(db)
+    if ids is None:
+        return
+    if strong:
+        ids.add(id)
+    else:
+        ids.discard(id)
+
 class Conversation(object):
     def __init__(self, id, db):
         self.id = id
@@ -54,8 +85,11 @@ class Conversation(object):
 
     @classmethod
     def _lookup(cls, id, initializer, db):
+        conv = _cache.get((db, id))
+        if conv is not None:
+            return conv
         conv = Conversation(id, db)
-        with sqlite3.connect(db) as c:
+        with database.connect(db) as c:
             cur = c.cursor()
             cur.execute('''select
                 last_active_time,
@@ -69,6 +103,8 @@ class Conversation(object):
         if row is None:
             initializer(conv)
             conv.store()
+            _cache.put((db, id), conv)
+            database.after_rollback(db, conv._uncache)
             return conv
         conv.last_active_time = util.from_ts(row[0])
         #print "Loaded conv last active", conv.last_active_time
@@ -78,6 +114,7 @@ class Conversation(object):
         conv.channel = row[4]
         conv.is_team = row[5]
         conv.topic = row[6]
+        _cache.put((db, id), conv)
         return conv
 
     def get_reminder(self):
@@ -86,18 +123,10 @@ class Conversation(object):
         return Reminder.lookup(self.reminder_id, self.db)
 
     def get_all_reminders(self):
-        reminders = []
-        with sqlite3.connect(self.db) as c:
-            c.row_factory = sqlite3.Row
-            cur = c.cursor()
-            cur.execute('''select rowid, * from reminders where conv_id=?
-                    and reminder_time>=?
-                    and deleted=0
-                    order by reminder_time''',
-                    (self.id, util.to_ts(util.now_utc())))
-            for row in cur:
-                reminders.append(Reminder.from_row(row, self.db))
-        return reminders
+        return list(self.upcoming_reminders())
+
+    def upcoming_reminders(self):
+        return UpcomingReminders(self)
 
     def is_recently_active(self):
         MINUTES = 30
@@ -122,10 +151,11 @@ class Conversation(object):
         self.context = context
         self.reminder_id = reminder_id
 
-        with sqlite3.connect(self.db) as c:
-            c.execute('''update conversations set
-                context=?, reminder_rowid=? where id=?''',
-                (context, reminder_id, self.id))
+        self._write('''update conversations set
+            context=?, reminder_rowid=? where id=?''',
+            (context, reminder_id, self.id))
+        strong = self.is_strong_context()
+        database.after_commit(self.db, lambda: _strong_context_changed(self.db, self.id, strong))
 
     def clear_context(self):
         if self.context == CTX_WHEN and self.reminder_id:
@@ -141,21 +171,34 @@ class Conversation(object):
             when = util.now_utc()
         self.last_active_time = when
         #print "Setting last active time!", self.last_active_time
-        with sqlite3.connect(self.db) as c:
-            cur = c.cursor()
-            cur.execute('update conversations set last_active_time=? where id=?',
-                    (util.to_ts(self.last_active_time), self.id))
-            assert cur.rowcount == 1
+        rows = self._write('update conversations set last_active_time=? where id=?',
+                (util.to_ts(self.last_active_time), self.id))
+        assert rows == 1
 
     def set_debug(self, val=True):
         self.debug = val
-        with sqlite3.connect(self.db) as c:
-            c.execute('update conversations set debug=? where id=?', (val, self.id))
+        self._write('update conversations set debug=? where id=?', (val, self.id))
+
+    # Runs an update of this conversation, returning the number of rows changed. The caller has
+    # already changed the object, so if the update doesn't commit it's dropped from the cache,
+    # and the next lookup reads what's really in the db.
+    def _write(self, sql, params):
+        try:
+            with database.connect(self.db) as c:
+                rows = c.execute(sql, params).rowcount
+        except:
+            self._uncache()
+            raise
+        database.after_rollback(self.db, self._uncache)
+        return rows
+
+    def _uncache(self):
+        _cache.pop((self.db, self.id))
 
     def store(self):
         active_ts = util.to_ts(self.last_active_time) if self.last_active_time else 0
         #print "storing new conv " + self.channel
-        with sqlite3.connect(self.db) as c:
+        with database.connect(self.db) as c:
             c.execute('''insert into conversations (
                 id,
                 channel,
@@ -177,5 +220,52 @@ class Conversation(object):
     # Delete the conversation from the database, doesn't delete related reminders
     # TODO make sure a reminder can be sent to a conversation that isn't in the DB
     def delete(self):
-        with sqlite3.connect(self.db) as c:
+        self._uncache()
+        wordindex.conversation_deleted(self.db, self.id)
+        _strong_context_changed(self.db, self.id, False)
+        with database.connect(self.db) as c:
             c.execute('delete from conversations where id=?', (self.id,))
+
+class UpcomingReminders(object):
+    '''
+    A conversation's upcoming reminders, in the order they're listed. Nothing is read from the db
+    until they're iterated over (one row at a time) or looked up by position.
+    '''
+    QUERY = '''select rowid, * from reminders where conv_id=?
+        and reminder_time>=?
+        and deleted=0
+        order by reminder_time'''
+
+    def __init__(self, conv):
+        self.conv = conv
+
+    def __iter__(self):
+        with database.connect(self.conv.db) as c:
+            cur = c.execute(self.QUERY, (self.conv.id, util.to_ts(util.now_utc())))
+            for row in cur:
+                yield Reminder.from_row(row, self.conv.db)
+
+    def at(self, i):
+        # The reminder at 0-based position i, or None.
+        with database.connect(self.conv.db) as c:
+            row = c.execute(self.QUERY + ' limit 1 offset ?',
+                    (self.conv.id, util.to_ts(util.now_utc()), i)).fetchone()
+        return Reminder.from_row(row, self.conv.db) if row else None
+
+    def best_text_match(self, word_lists):
+        # The first reminder whose body has the most words from one of the lists, and its score
+        # (see WordIndex.scores), or (None, 0).
+        scores = wordindex.lookup(self.conv.db, self.conv.id).scores(word_lists)
+        if not scores:
+            return None, 0
+        best = (None, 0)
+        with database.connect(self.conv.db) as c:
+            cur = c.execute('''select rowid, * from reminders where conv_id=?
+                and reminder_time>=?
+                and deleted=0
+                and rowid in (select value from json_each(?))
+                order by reminder_time''', (self.conv.id, util.to_ts(util.now_utc()), json.dumps(list(scores))))
+            for row in cur:
+                if scores[row["rowid"]] > best[1]:
+                    best = (Reminder.from_row(row, self.conv.db), scores[row["rowid"]])
+        return best
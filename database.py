@@ -1,8 +1,116 @@
+import asyncio, concurrent.futures, contextlib, contextvars, functools, json, sqlite3, sys, threading
+
 import sentry_sdk
-import sqlite3
-import sys
 
-import keybase
+# Applied to every connection we open. WAL lets the reminder loop read while a message is being
+# written, and makes synchronous=normal safe (a crash can lose the last commit, never corrupt).
+PRAGMAS = (
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', -16000),         # KiB, so 16MB
+    ('mmap_size', 64 * 1024 * 1024),
+    ('busy_timeout', 5000),         # ms
+)
+
+# Open connections, one per (thread, db file), since a connection mustn't be used by two threads
+# at once.
+_connections = {}
+_connections_lock = threading.Lock()
+
+def get_connection(db):
+    key = (threading.get_ident(), db)
+    c = _connections.get(key)
+    if c is None:
+        # check_same_thread=False only so close_all() can close it from another thread
+        c = sqlite3.connect(db, check_same_thread=False)
+        c.row_factory = sqlite3.Row
+        for name, value in PRAGMAS:
+            c.execute('pragma {} = {}'.format(name, value))
+        with _connections_lock:
+            _connections[key] = c
+    return c
+
+class UnitOfWork(object):
+    def __init__(self, db):
+        self.db = db
+        self.after_commit = []
+        self.after_rollback = []
+
+# The unit of work open in the current context, if any. See unit_of_work().
+_unit_of_work = contextvars.ContextVar('unit_of_work', default=None)
+
+def _current(db):
+    uow = _unit_of_work.get()
+    return uow if uow is not None and uow.db == db else None
+
+@contextlib.contextmanager
+def connect(db):
+    # Drop-in for `with sqlite3.connect(db) as c`: commits on success, rolls back on error,
+    # but keeps the connection open for the next caller.
+    c = get_connection(db)
+    if _current(db):
+        # the unit of work commits or rolls back
+        yield c
+        return
+    with c:
+        yield c
+
+@contextlib.contextmanager
+def unit_of_work(db):
+    # Everything written through connect() inside this block is committed as one transaction
+    # when it ends, or rolled back if it raises. Don't await inside it: another task could write
+    # on the same connection in the meantime and commit half of the unit.
+    if _current(db):
+        yield
+        return
+    c = get_connection(db)
+    uow = UnitOfWork(db)
+    token = _unit_of_work.set(uow)
+    try:
+        with c:
+            yield
+    except BaseException:
+        for fn in uow.after_rollback:
+            fn()
+        raise
+    finally:
+        _unit_of_work.reset(token)
+    for fn in uow.after_commit:
+        fn()
+
+def after_commit(db, fn):
+    # Calls fn once the writes made so far are committed: now, unless a unit of work is open.
+    # If the unit of work rolls back, fn is never called.
+    uow = _current(db)
+    if uow:
+        uow.after_commit.append(fn)
+    else:
+        fn()
+
+def after_rollback(db, fn):
+    # Calls fn if the unit of work that's open rolls back. Without one, does nothing: a write
+    # outside a unit of work that fails raises straight to the caller.
+    uow = _current(db)
+    if uow:
+        uow.after_rollback.append(fn)
+
+# Database work started from the event loop runs here, one job at a time, so a slow disk or a
+# lock wait doesn't hold up chat I/O. A single thread also means a unit of work run as one job
+# can't interleave with anyone else's writes.
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+
+async def run(fn, *args):
+    # Awaitable version of fn(*args), e.g. `await database.run(Conversation.lookup, id, db)`.
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, functools.partial(ctx.run, fn, *args))
+
+def close_all():
+    # Only call this when no database work is running.
+    with _connections_lock:
+        for c in _connections.values():
+            c.close()
+        _connections.clear()
 
 def initial_tables(c):
     c.execute('''create table if not exists reminders (
@@ -38,9 +146,55 @@ def add_reminder_repeating(c):
 def add_reminder_errors(c):
     c.execute('alter table reminders add errors int not null default 0')
 
+def add_reminder_next_attempt(c):
+    c.execute('alter table reminders add next_attempt_time int')
+    c.execute('''create table if not exists dead_reminders (
+        reminder_rowid int not null,
+        reminder_time int,
+        created_time int not null,
+        body text not null,
+        user text not null,
+        conv_id text not null,
+        repetition_interval text,
+        repetition_nth int,
+        errors int not null,
+        error text,
+        dead_time int not null)''')
+
+def add_sent_reminders(c):
+    # Repeating reminders are moved on in place, so this is the only history of past sends.
+    c.execute('''create table if not exists sent_reminders (
+        reminder_rowid int not null,
+        reminder_time int not null,
+        sent_time int not null)''')
+
+def add_reminder_deleted_index(c):
+    # Lets the vacuum find soft-deleted reminders without scanning the live ones.
+    c.execute('create index if not exists idx_reminder_deleted on reminders(deleted) where deleted=1')
+
+def add_live_reminder_indexes(c):
+    # Most reminders are old and soft-deleted, and every hot query skips those.
+    c.execute('create index if not exists idx_reminder_due on reminders(reminder_time) where deleted=0')
+    # Has every column, so listing a conversation's reminders never reads the table.
+    c.execute('''create index if not exists idx_reminder_conv_live on reminders(conv_id, reminder_time,
+        created_time, body, user, deleted, repetition_interval, repetition_nth, errors, next_attempt_time)
+        where deleted=0''')
+    c.execute('create index if not exists idx_reminder_user on reminders(user)')
+    c.execute('drop index if exists idx_reminder_time')
+    c.execute('drop index if exists idx_reminder_conv')
+
+def add_user_settings_columns(c):
+    # The settings used to be a json blob, which had to be parsed on every lookup.
+    c.execute('alter table users add timezone text')
+    c.execute('alter table users add has_seen_help boolean not null default 0')
+    for username, settings in c.execute('select username, settings from users').fetchall():
+        settings = json.loads(settings)
+        c.execute('update users set timezone=?, has_seen_help=?, settings=? where username=?',
+                (settings.get('timezone'), settings.get('has_seen_help', False), '{}', username))
+
 def setup(db):
     try:
-        c = sqlite3.connect(db)
+        c = get_connection(db)
     except sqlite3.OperationalError as e:
         sentry_sdk.capture_exception()
         print >> sys.stderr, "FATAL: Error connecting to " + db + ": " + e.message
@@ -54,7 +208,12 @@ def setup(db):
             initial_tables,
             add_reminder_deleted,
             add_reminder_repeating,
-            add_reminder_errors
+            add_reminder_errors,
+            add_reminder_next_attempt,
+            add_sent_reminders,
+            add_reminder_deleted_index,
+            add_live_reminder_indexes,
+            add_user_settings_columns,
         ]
     for i, migration in enumerate(migrations, start=1):
         if db_version < i:
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3.8
+
+# Inspect and replay reminders that failed to send too many times.
+#   python3 deadletters.py --config local.ini              # list them
+#   python3 deadletters.py --config local.ini replay 12    # send #12 again now
+
+import argparse
+
+import bot, database, reminders, util
+
+def print_dead_reminders(db):
+    rows = reminders.get_dead_reminders(db)
+    if not rows:
+        print("No dead reminders.")
+    for row in rows:
+        print("#{} [{}] @{} in {}: {}".format(row["rowid"], util.from_ts(row["dead_time"]),
+            row["user"], row["conv_id"], row["body"]))
+        print("    {} errors, last: {}".format(row["errors"], row["error"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Reminders that failed to send.')
+    parser.add_argument('--config', default='default.ini',
+                        help='config file')
+    parser.add_argument('command', nargs='?', default='list', choices=('list', 'replay'))
+    parser.add_argument('ids', nargs='*', type=int, help='dead reminders to replay')
+    args = parser.parse_args()
+
+    config = bot.Config.fromFile(args.config)
+    database.setup(config.db)
+    if args.command == 'list':
+        print_dead_reminders(config.db)
+    else:
+        for dead_id in args.ids:
+            reminder = reminders.replay_dead_reminder(dead_id, config.db)
+            print("#{} is reminder {} again, due now.".format(dead_id, reminder.id))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3.8
+
+# Prints the query plan of every SQL statement in the bot, run against a throwaway database
+# full of made up reminders, so a query that stops using an index shows up as a SCAN.
+#   python3 explain.py
+#   python3 explain.py --reminders 1000000
+
+import argparse, ast, glob, os, random, sqlite3, tempfile
+
+import database
+
+USERS = 1000
+CONVERSATIONS = 2000
+
+# The first argument of every c.execute('...') / cur.executemany('...') / self._write('...')
+# whose query can be read off the source, as (file, line, sql). Besides literals that's string
+# constants (module or class level, e.g. QUERY or self.QUERY) and `+`s of those.
+def find_queries(paths):
+    for path in paths:
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        constants = string_constants(tree)
+        for node in ast.walk(tree):
+            if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                    and node.func.attr in ('execute', 'executemany', '_write') and node.args):
+                continue
+            sql = resolve(node.args[0], constants)
+            if sql is not None:
+                yield path, node.lineno, sql
+
+def string_constants(tree):
+    # name -> value for every NAME = '...' at module or class level
+    constants = {}
+    scopes = [tree] + [node for node in ast.walk(tree) if isinstance(node, ast.ClassDef)]
+    for scope in scopes:
+        for node in scope.body:
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 \
+                    and isinstance(node.targets[0], ast.Name):
+                value = resolve(node.value, constants)
+                if value is not None:
+                    constants[node.targets[0].id] = value
+    return constants
+
+def resolve(node, constants):
+    # The string the expression always is, or None.
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.Name):
+        return constants.get(node.id)
+    if isinstance(node, ast.Attribute):
+        return constants.get(node.attr)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left, right = resolve(node.left, constants), resolve(node.right, constants)
+        if left is not None and right is not None:
+            return left + right
+    return None
+
+def is_query(sql):
+    return sql.split(None, 1)[0].lower() in ('select', 'insert', 'update', 'delete')
+
+def fill(db, n):
+    now = 1523235748
+    with database.connect(db) as c:
+        c.executemany('insert into users (username, settings) values (?, ?)',
+                (('user{}'.format(i), '{}') for i in range(USERS)))
+        c.executemany('''insert into conversations (id, channel, is_team, last_active_time, context, debug)
+                values (?, ?, 0, ?, 0, 0)''',
+                (('conv{}'.format(i), 'user{}'.format(i % USERS), now) for i in range(CONVERSATIONS)))
+        # Mostly old ones that were sent or deleted, like a bot that's been running a while.
+        c.executemany('''insert into reminders (reminder_time, created_time, body, user, conv_id, deleted)
+                values (?, ?, ?, ?, ?, ?)''',
+                ((now + random.randint(-10**7, 10**7), now, 'something', 'user{}'.format(i % USERS),
+                  'conv{}'.format(i % CONVERSATIONS), random.random() < 0.9) for i in range(n)))
+
+def explain(c, sql):
+    params = (None,) * sql.count('?')
+    return [row[3] for row in c.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query plans for the SQL in the bot.')
+    parser.add_argument('--reminders', type=int, default=100000, help='reminders in the database')
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    # just the bot, not the tests and tools
+    paths = [p for p in sorted(glob.glob(os.path.join(here, '*.py')))
+            if not os.path.basename(p).endswith('_test.py')
+            and os.path.basename(p) not in ('bench.py', 'explain.py')]
+    with tempfile.TemporaryDirectory() as d:
+        db = os.path.join(d, 'explain.db')
+        database.setup(db)
+        fill(db, args.reminders)
+        with database.connect(db) as c:
+            for path, line, sql in find_queries(paths):
+                if not is_query(sql):
+                    continue
+                print("{}:{}".format(os.path.basename(path), line))
+                print("    " + " ".join(sql.split()))
+                try:
+                    for step in explain(c, sql):
+                        print("    -> " + step)
+                except sqlite3.Error as e:
+                    print("    !! " + str(e))
+                print()
+        database.close_all()
@@ -1,70 +1,47 @@
 # Utilities for interacting with the keybase chat api
 
-import asyncio, json, sys
+import asyncio, collections, sys, time, weakref
+
+import metrics, util
 from user import User
 from pykeybasebot.types import chat1
 
 class Message(object):
     '''
-    Example message json: {
-        u'msg': {
-            u'unread': True,
-            u'sent_at': 1522813326,
-            u'sent_at_ms': 1522813326658,
-            u'content': {u'text': {u'body': u'Hi'}, u'type': u'text'},
-            u'prev': [{u'hash': u'DEZRY/2G+NYYgB34g1X9ocuFqfBBDIfEHvT+qOwotqE=', u'id': 1}],
-            u'id': 2,
-            u'channel': {
-                u'members_type': u'impteamnative',
-                u'topic_type': u'chat',
-                u'name': u'jessk,reminderbot',
-                u'public': False
-            },
-            u'bot_info': {
-                u'bot_uid': 'f1f49e2da3db6392b47dc913b4e85519',
-                u'bot_username': 'reminderbot'
-            },
-            u'sender': {
-                u'username': u'jessk',
-                u'device_name': u'phone',
-                u'uid': u'653ba091fa61606e5a3c8fb2086b3419',
-                u'device_id': u'c4aec52a455b551af3b042c46537fc18'
-            }
-        }
-    }
-        '''
-    def __init__(self, conv_id, json, db):
-        self.text = json["msg"]["content"]["text"]["body"]
-        self.author = json["msg"]["sender"]["username"]
+    The parts of an incoming chat message the bot looks at, read straight off the pykeybasebot
+    MsgSummary. For the whole message, see chat1.MsgSummary or the chat api's json, e.g.
+    {"msg": {"content": {"text": {"body": "Hi"}, "type": "text"},
+             "channel": {"members_type": "impteamnative", "name": "jessk,reminderbot", ...},
+             "bot_info": {"bot_username": "reminderbot", ...},
+             "sender": {"username": "jessk", ...}, ...}}
+    '''
+    __slots__ = ("text", "author", "conv_id", "channel_members_type", "channel_name",
+            "bot_username", "db")
+
+    def __init__(self, conv_id, text, author, channel_name, channel_members_type, bot_username, db):
+        self.text = text
+        self.author = author
         self.conv_id = conv_id
-        self.channel_members_type =json["msg"]["channel"]["members_type"]
-        self.channel_name = json["msg"]["channel"]["name"]
-        self.bot_username = (json["msg"].get("bot_info", {}) or {}).get("bot_username")
+        self.channel_members_type = channel_members_type
+        self.channel_name = channel_name
+        self.bot_username = bot_username
         self.db = db
 
     @classmethod
     def from_msgsummary(cls, msg_summary, db):
+        bot_info = msg_summary.bot_info
         return Message(
             msg_summary.conv_id,
-            {"msg": json.loads(msg_summary.to_json())},
-            db
-        )
-        # self.text = msg_summary.content.text.body
-        # self.author = msg_summary.sender.username
-        # self.conv_id = msg_summary.conv_id
-        # self.channel_members_type = msg_summary.channel.members_type
-        # self.channel_name = msg_summary.channel.name
-        # self.bot_username = msg_summary.bot_info.bot_username if msg_summary.bot_info else None
-        # self.db = db
+            msg_summary.content.text.body,
+            msg_summary.sender.username,
+            msg_summary.channel.name,
+            msg_summary.channel.members_type,
+            bot_info.bot_username if bot_info else None,
+            db)
 
     @classmethod
     def inject(cls, text, author, conv_id, channel, db):
-        return Message(conv_id, {"msg": {
-            "content": {"text": {"body": text}},
-            "sender": {"username": author},
-            "channel": {
-                "name": channel,
-                "members_type": "impteamnative"}}}, db)
+        return Message(conv_id, text, author, channel, "impteamnative", None, db)
 
     def user(self):
         return User.lookup(self.author, self.db)
@@ -74,10 +51,128 @@ class Message(object):
         # restricted bot member
         return self.channel_members_type != "team" and self.channel_name.count(',') <= 1
 
+class Outbox(object):
+    '''
+    Replies to an event, held back until its database writes are committed.
+    '''
+    def __init__(self, bot, config):
+        self.bot = bot
+        self.config = config
+        self.pending = []
+
+    def send(self, conv_id, msg):
+        self.pending.append(lambda: send(self.bot, conv_id, msg))
+
+    def debug(self, conv, message):
+        self.pending.append(lambda: debug(self.bot, conv, message, self.config))
+
+    async def flush(self):
+        pending, self.pending = self.pending, []
+        for fn in pending:
+            await fn()
+
+# Outgoing messages (see SendQueue)
+SEND_CONCURRENCY = 8 # conversations being sent to at once
+SEND_RETRIES = 3
+SEND_RETRY_BASE_SECONDS = 0.5
+SEND_RETRY_MAX_SECONDS = 8
+
+# Send errors that would only happen again if the send was retried.
+PERMANENT_ERRORS = (
+    "no conversations matched", # the bot was removed from the conversation
+    "user is not in conversation", # the bot can't write there
+)
+
+def is_permanent_error(e):
+    message = getattr(e, 'message', None) or str(e)
+    return isinstance(message, str) and message.startswith(PERMANENT_ERRORS)
+
+class SendQueue(object):
+    '''
+    Messages waiting to be sent, a queue per conversation. Each conversation's messages go out one
+    at a time in the order they were queued, and no more than `concurrency` conversations are
+    sent to at once. A failed send is retried with exponential backoff (holding up only its own
+    conversation) unless the error is permanent.
+    '''
+    def __init__(self, concurrency=SEND_CONCURRENCY, retries=SEND_RETRIES):
+        self.retries = retries
+        self.limit = asyncio.Semaphore(concurrency)
+        self.queues = {} # queue key -> deque of (bot, conv_id, msg, future, queued time)
+        self.workers = {} # queue key -> the task sending its queue
+
+    def submit(self, bot, conv_id, msg):
+        # Queues the message. conv_id is a conversation id or a chat1.ChatChannel. Returns a
+        # future for the send: None, or the error it gave up on.
+        future = asyncio.get_running_loop().create_future()
+        key = _queue_key(conv_id)
+        queue = self.queues.setdefault(key, collections.deque())
+        queue.append((bot, conv_id, msg, future, time.monotonic()))
+        metrics.observe("send.queue_depth", self.depth())
+        if key not in self.workers:
+            self.workers[key] = asyncio.ensure_future(self._work(key))
+        return future
+
+    def depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def _work(self, key):
+        queue = self.queues[key]
+        try:
+            while queue:
+                bot, conv_id, msg, future, queued = queue[0]
+                if not future.cancelled():
+                    error = await self._send(bot, conv_id, msg)
+                    metrics.observe("send.seconds", time.monotonic() - queued)
+                    if not future.cancelled():
+                        if error is None:
+                            future.set_result(None)
+                        else:
+                            future.set_exception(error)
+                queue.popleft()
+        finally:
+            del self.queues[key]
+            del self.workers[key]
+
+    async def _send(self, bot, conv_id, msg):
+        # None once it's sent, or the error it gave up on.
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.limit: # not held while waiting to retry
+                    await bot.chat.send(conv_id, msg)
+                metrics.incr("send.sent")
+                return None
+            except Exception as e:
+                if is_permanent_error(e):
+                    metrics.incr("send.permanent_errors")
+                    return e
+                if attempt == self.retries:
+                    metrics.incr("send.failed")
+                    return e
+                metrics.incr("send.retries")
+                await asyncio.sleep(util.backoff(attempt, SEND_RETRY_BASE_SECONDS, SEND_RETRY_MAX_SECONDS))
+
+def _queue_key(conv_id):
+    # ChatChannels (like the debug channel) aren't hashable.
+    if isinstance(conv_id, chat1.ChatChannel):
+        return (conv_id.name, conv_id.topic_name)
+    return conv_id
+
+# A queue per event loop (tests run each in its own).
+_send_queues = weakref.WeakKeyDictionary()
+
+def send_queue():
+    loop = asyncio.get_running_loop()
+    queue = _send_queues.get(loop)
+    if queue is None:
+        queue = _send_queues[loop] = SendQueue()
+    return queue
+
+def submit(bot, conv_id, msg):
+    # Queues the message to be sent, returning a future for it (see SendQueue.submit).
+    return send_queue().submit(bot, conv_id, msg)
+
 async def send(bot, conv_id, msg):
-    async def _send():
-        await bot.chat.send(conv_id, msg)
-    await _with_retries(_send)
+    await submit(bot, conv_id, msg)
 
 async def debug(bot, conv, message, config):
     channel = _debug_channel(config)
@@ -86,16 +181,6 @@ async def debug(bot, conv, message, config):
     else:
         print("[DEBUG]", message, file=sys.stderr)
 
-async def _with_retries(fn, retries=3):
-    try:
-        await fn()
-    except Exception as e:
-        if retries:
-            await asyncio.sleep(1)
-            await _with_retries(fn, retries-1)
-        else:
-            raise e
-
 def _debug_channel(config):
     if not config.debug_team or not config.debug_topic:
         return None
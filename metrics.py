@@ -0,0 +1,54 @@
+# Counters and timings, printed periodically by the bot
+
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+
+class Timing(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __str__(self):
+        return "n={} mean={:.3f} max={:.3f}".format(self.count, self.mean(), self.max)
+
+def incr(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def observe(name, value):
+    with _lock:
+        if name not in _timings:
+            _timings[name] = Timing()
+        _timings[name].add(value)
+
+def counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+def timing(name):
+    with _lock:
+        return _timings.get(name, Timing())
+
+def report():
+    with _lock:
+        lines = [name + ": " + str(value) for name, value in sorted(_counters.items())]
+        lines += [name + ": " + str(value) for name, value in sorted(_timings.items())]
+    for line in lines:
+        print("[METRIC]", line)
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timings.clear()
@@ -1,11 +1,12 @@
 # Parsing messages
 
-import dateparser, itertools, nltk, pytz, re
+import asyncio, concurrent.futures, contextvars, dateparser, functools, nltk, pytz, re
 
-import conversation, util
+import conversation, metrics, timezones, util
 from reminders import Reminder, Repetition, INTERVALS
 from user import User
 from collections import namedtuple
+from functools import cached_property
 from datetime import datetime, timedelta # don't use anything that uses now.
 from keybase import debug
 
@@ -26,7 +27,99 @@ MSG_NODEBUG    = "NODEBUG"
 MSG_SNOOZE     = "SNOOZE"
 MSG_DELETE     = "DELETE"
 
-def try_parse_when(when, user):
+# Messages are parsed here, not on the database thread (see database.run): dateparser and NLTK
+# take milliseconds, and the reminder loop would wait behind them. Parsing only reads, which WAL
+# lets it do while the database thread writes. One thread, so messages parse in the order they
+# come and the parsers' own caches are never shared.
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='parse')
+
+async def run(fn, *args):
+    # Awaitable version of fn(*args), e.g. `await parse.run(parse.parse_message, message, conv, config)`.
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, functools.partial(ctx.run, fn, *args))
+
+def regex(s):
+    return re.compile(s, re.IGNORECASE)
+
+# Every pattern is compiled once, here.
+
+# "10:30", "10:30 pm"
+TIME_WITH_MINUTES = regex('(?:[^\w]|^)(\d\d?(:\d\d))(\s?[ap]\.?m)?')
+# "at 10", "at 10pm"
+AT_HH = regex('(?:(?:^|\s)at\s|^)(\d\d?)($|\s?[ap]\.?m\.?(?:$|[^\w]))')
+
+REPETITION_DAYS = set(["sunday", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday"])
+REPETITION_DAY_INTERVALS = set(["day", "night", "evening", "morning", "afternoon"])
+# "every other tuesday at 10am": nth, interval, rest
+REPETITION_PATTERNS = [regex("(?:on )?every (?:(?P<nth>\w+) )?(?P<interval>" + i + ")s?(?:$|(?: (?P<rest>.+)))")
+        for i in REPETITION_DAYS | REPETITION_DAY_INTERVALS | set(INTERVALS)]
+REPETITION_NTHS = {"other": 2, "second": 2, "third": 3, "fourth": 4}
+NTH = regex("(\d+)[a-z]*")
+
+# Where the when might start in "remind me to <what> <when>"
+TIME_PHRASES = [regex("(.*)(" + p + ".*)") for p in (" every ", " today", " tomorrow",
+    " next ", " sunday", " monday", " tuesday", " wednesday", " thursday", " friday",
+    "saturday", " at ", " on ", " in ")]
+REMIND_WHEN_WHAT = regex("(?:remind me|remind us|reminder) (.*?) to (.*)")
+REMIND_WHAT_WHEN = regex("(?:remind me|remind us|reminder) to (.*)")
+
+TIMEZONE_STARTS = [regex(p + "(.*)") for p in ("timezone", "time zone")]
+# words that can come between "timezone" and the timezone
+TIMEZONE_FILLERS = ("to", "is", "now", "be", "as", "in", "=", "-")
+
+# The whens people send most, which try_parse_common_when reads without dateparser.
+# "in 5 minutes", "in an hour"
+COMMON_IN = regex(r"^in (\d+|an?) (min|mins|minutes?|hours?|days?|weeks?)$")
+# "10am", "10:30 pm", "22:30"
+COMMON_TIME = r"(?:(?P<h12>\d\d?)(?::(?P<m12>\d\d))? ?(?P<ampm>[ap])\.?m\.?|(?P<h24>\d\d?):(?P<m24>\d\d))"
+COMMON_DATE = r"(?P<date>today|tomorrow|next week|(?:on )?(?P<weekday>sunday|monday|tuesday|wednesday|thursday|friday|saturday))"
+# "tomorrow", "on tuesday at 8am", "at 5pm", "10:30pm today"
+COMMON_DATE_TIME = [regex("^" + p + "$") for p in (
+    COMMON_DATE,
+    COMMON_DATE + " (?:at )?" + COMMON_TIME,
+    "(?:at )?" + COMMON_TIME + "(?: " + COMMON_DATE + ")?")]
+COMMON_UNITS = {"min": "minutes", "mins": "minutes", "minute": "minutes", "minutes": "minutes",
+        "hour": "hours", "hours": "hours", "day": "days", "days": "days", "week": "weeks", "weeks": "weeks"}
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+UNDOS = [regex("(^|\s)" + undo + "($|\s)")
+        for undo in ("undo", "never ?mind", "no", "undo that", "delete that", "nvm")]
+NON_WORDS = re.compile(r"\W+")
+SNOOZE = regex(r"^snooze\s+(?:for)?\s*(.*)$")
+
+class ParseContext(object):
+    '''
+    What the parsers need to know about a message besides its text. Each part is worked out the
+    first time a parser asks for it, and then kept for the rest of the message.
+    '''
+    def __init__(self, message, conv, config):
+        self.message = message
+        self.conv = conv
+        self.config = config
+
+    @cached_property
+    def user(self):
+        return self.message.user()
+
+    @cached_property
+    def timezone_str(self):
+        return self.user.timezone if self.user.timezone else 'US/Eastern'
+
+    @cached_property
+    def tz(self):
+        return pytz.timezone(self.timezone_str)
+
+    @cached_property
+    def now(self):
+        return util.now_utc()
+
+    @cached_property
+    def relative_base(self):
+        # now in the user's timezone, without the timezone, as dateparser takes it
+        return self.now.astimezone(self.tz).replace(tzinfo=None)
+
+def try_parse_when(when, ctx):
     def fixup_times(when_str, relative_base):
         # When there is no explicit AM/PM.
         # Assume the next upcoming one H:MM (AM|PM)?
@@ -34,8 +127,7 @@ def try_parse_when(when, user):
         def hhmm_explicit_ampm(when_str, relative_base):
             # looks for HH:MM without an AM or PM and adds 12 to the HH if necessary.
             # Returns str if the returned str is good to go, None if it's not fixed.
-            time_with_minutes = regex('(?:[^\w]|^)(\d\d?(:\d\d))(\s?[ap]\.?m)?')
-            results = re.findall(time_with_minutes, when_str)
+            results = TIME_WITH_MINUTES.findall(when_str)
             if len(results) != 1:
                 # I don't expect to find more than one time. Rather not do anything.
                 return None
@@ -61,8 +153,7 @@ def try_parse_when(when, user):
 
         def at_hh_explicit_ampm(when_str, relative_base):
             # looks for "at HH" without AM/PM and adds 12 to HH and :00 if necessary.
-            at_hh_regex = regex('(?:(?:^|\s)at\s|^)(\d\d?)($|\s?[ap]\.?m\.?(?:$|[^\w]))')
-            results = re.findall(at_hh_regex, when_str)
+            results = AT_HH.findall(when_str)
             if len(results) != 1:
                 # I don't expect to find more than one time. Rather not do anything.
                 return None
@@ -101,13 +192,7 @@ def try_parse_when(when, user):
         if not "every" in when_str:
             return when_str, Repetition(None, None)
         when_str = when_str.replace("week day", "weekday")
-        days = set(["sunday", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday"])
-        intervals_day = set(["day", "night", "evening", "morning", "afternoon"])
-        intervals = set(INTERVALS)
-        # 0: nth; 1: interval; 2: rest (e.g. "at 2pm")
-        regexes = [regex("(?:on )?every (?:(?P<nth>\w+) )?(?P<interval>" + i + ")s?(?:$|(?: (?P<rest>.+)))") for i in days | intervals_day | intervals]
-
-        for r in regexes:
+        for r in REPETITION_PATTERNS:
             match = r.search(when_str)
             if match:
                 nth_text = match.group('nth')
@@ -115,12 +200,10 @@ def try_parse_when(when, user):
                 rest = match.group('rest')
                 if nth_text:
                     nth_text = nth_text.lower()
-                    nths = {"other": 2, "second": 2, "third": 3, "fourth": 4}
-                    if nth_text in nths:
-                        nth = nths[nth_text]
+                    if nth_text in REPETITION_NTHS:
+                        nth = REPETITION_NTHS[nth_text]
                     else:
-                        nth_regex = regex("(\d+)[a-z]*")
-                        nth_match = nth_regex.search(nth_text)
+                        nth_match = NTH.search(nth_text)
                         if nth_match:
                             nth = int(match.group(1))
                         else:
@@ -131,9 +214,9 @@ def try_parse_when(when, user):
                     nth = 1
                 if interval:
                     interval = interval.lower()
-                if interval in intervals_day:
+                if interval in REPETITION_DAY_INTERVALS:
                     interval = "day"
-                if interval in days:
+                if interval in REPETITION_DAYS:
                     if rest:
                         rest = interval + " " + rest
                     else:
@@ -146,8 +229,8 @@ def try_parse_when(when, user):
         return when_str, Repetition(None, None)
     
     # include RELATIVE_BASE explicitly so we can mock now in tests
-    local_timezone_str = user.timezone if user.timezone else 'US/Eastern'
-    relative_base = util.now_local(local_timezone_str).replace(tzinfo=None)
+    local_timezone_str = ctx.timezone_str
+    relative_base = ctx.relative_base
     when = fixup_times(when, relative_base)
     when, repetition = extract_repetition(when)
     parse_date_settings = {
@@ -157,56 +240,163 @@ def try_parse_when(when, user):
             'TIMEZONE': local_timezone_str,
             'RETURN_AS_TIMEZONE_AWARE': True,
             'RELATIVE_BASE': relative_base}
-    dt = dateparser.parse(when, settings=parse_date_settings)
-    if dt != None and (dt - util.now_utc()).total_seconds() < 0:
+    dt = try_parse_common_when(when, relative_base, ctx.tz)
+    if dt is None:
+        dt = parse_date(when, relative_base, local_timezone_str, parse_date_settings)
+    if dt != None and (dt - ctx.now).total_seconds() < 0:
         return None, None
     return dt, repetition
 
-def regex(s):
-    return re.compile(s, re.IGNORECASE)
+def try_parse_common_when(when, relative_base, tz):
+    # Reads the most common whens (see COMMON_IN and COMMON_DATE_TIME) the way dateparser would,
+    # only much faster. Returns a UTC datetime, or None for anything else, to go to dateparser.
+    # Unlike dateparser it gets a time alone ("at 9am") right in timezones ahead of UTC, and
+    # dates across a daylight saving change.
+    when = when.strip()
+    match = COMMON_IN.match(when)
+    if match:
+        n = match.group(1).lower()
+        n = 1 if n in ("a", "an") else int(n)
+        try:
+            local = relative_base + timedelta(**{COMMON_UNITS[match.group(2).lower()]: n})
+            return _localize(local, tz)
+        except (OverflowError, ValueError):
+            # past the year 9999, let dateparser turn it down
+            return None
+
+    for pattern in COMMON_DATE_TIME:
+        match = pattern.match(when)
+        if match:
+            break
+    else:
+        return None
+    parts = match.groupdict()
+    date = (parts.get("date") or "").lower()
+    if parts.get("ampm"):
+        hour, minute = int(parts["h12"]), int(parts["m12"] or 0)
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if parts["ampm"].lower() == "p" else 0)
+    elif parts.get("h24"):
+        hour, minute = int(parts["h24"]), int(parts["m24"])
+        if hour > 23:
+            return None
+    else:
+        # a date alone, e.g. "tomorrow": the time is now, or midnight for a day of the week
+        hour = minute = None
+    if minute is not None and minute > 59:
+        return None
 
-def try_parse_reminder(message):
+    local = relative_base
+    if date == "tomorrow":
+        local += timedelta(days=1)
+    elif date == "next week":
+        local += timedelta(weeks=1)
+    elif parts.get("weekday"):
+        # the next one, never today
+        days = (WEEKDAYS.index(parts["weekday"].lower()) - relative_base.weekday() - 1) % 7 + 1
+        local = (local + timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    elif date == "today" and hour is None:
+        return None
+    if hour is not None:
+        local = local.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if not date and local < relative_base:
+            # a time that's passed today means tomorrow
+            local += timedelta(days=1)
+    return _localize(local, tz)
+
+# Recent dateparser results, by (when, timezone, relative base to the hour). See parse_date.
+DATEPARSER_CACHE_SIZE = 4096
+_dateparser_cache = util.LRUCache("dateparser.cache", DATEPARSER_CACHE_SIZE)
+
+# What a when's result does as the relative base moves on, once it's been parsed twice
+WHEN_UNKNOWN = 0
+WHEN_RELATIVE = 1 # moves with it, e.g. "in 10 minutes"
+WHEN_ABSOLUTE = 2 # stays put, e.g. "tomorrow at 9am"
+WHEN_VOLATILE = 3 # neither, always ask dateparser
+
+class ParsedWhen(object):
+    def __init__(self, base, dt):
+        self.base = base
+        self.dt = dt
+        self.kind = WHEN_UNKNOWN
+
+    def learn(self, base, dt):
+        # Compare with parsing the same when from a later base.
+        if self.dt is None or dt is None:
+            self.kind = WHEN_ABSOLUTE if self.dt is dt else WHEN_VOLATILE
+        elif dt - self.dt == base - self.base:
+            self.kind = WHEN_RELATIVE
+        elif dt == self.dt:
+            self.kind = WHEN_ABSOLUTE
+        else:
+            self.kind = WHEN_VOLATILE
+
+# dateparser.parse(when), reusing the result for the same when earlier in the same hour.
+def parse_date(when, relative_base, local_timezone_str, settings):
+    when = " ".join(when.split())
+    key = (when, local_timezone_str, relative_base.replace(minute=0, second=0, microsecond=0))
+    cached = _dateparser_cache.get(key)
+    if cached is not None:
+        if relative_base == cached.base:
+            return cached.dt
+        if relative_base > cached.base:
+            if cached.kind == WHEN_RELATIVE:
+                return cached.dt + (relative_base - cached.base)
+            # unless it's passed, in which case dateparser might roll it over to the next day
+            if cached.kind == WHEN_ABSOLUTE and (cached.dt is None
+                    or cached.dt > _localize(relative_base, pytz.timezone(local_timezone_str))):
+                return cached.dt
+    metrics.incr("dateparser.calls")
+    dt = dateparser.parse(when, settings=settings)
+    if cached is None:
+        _dateparser_cache.put(key, ParsedWhen(relative_base, dt))
+    elif cached.kind == WHEN_UNKNOWN and relative_base > cached.base:
+        cached.learn(relative_base, dt)
+    return dt
+
+def _localize(local, tz):
+    return tz.localize(local).astimezone(pytz.utc)
+
+def try_parse_reminder(ctx):
 
     def split_reminder_when(text):
-        time_phrases = [regex("(.*)(" + p + ".*)") for p in (" every ", " today", " tomorrow",
-            " next ", " sunday", " monday", " tuesday", " wednesday", " thursday", " friday",
-            "saturday", " at ", " on ", " in ")]
-        possible_whens = [] #(int, reminder, datetime) tuples
-
-        for time_phrase in time_phrases:
+        # The when starts at one of the TIME_PHRASES, and the longest one that parses wins. Every
+        # candidate runs to the end of the text, so they're all different lengths: try them
+        # longest first and stop at the first that parses.
+        candidates = {} # when text -> reminder text
+        for time_phrase in TIME_PHRASES:
             match = time_phrase.search(text)
             if match:
-                reminder_text = match.group(1).strip()
-                when_text = match.group(2).strip()
-                when, repetition = try_parse_when(when_text, user) # may be None
-                possible_whens.append((len(when_text), reminder_text, when, repetition))
-
-        great_whens = [w for w in possible_whens if w[2]]
-        if len(great_whens):
-            _, reminder_text, when, repetition = max(great_whens, key=lambda pair: pair[0])
-        elif len(possible_whens):
-            _, reminder_text, when, repetition = max(possible_whens, key=lambda pair: pair[0])
-        else:
-            reminder_text = text
-            repetition = None
-            when = None
-        return reminder_text, when, repetition
+                candidates.setdefault(match.group(2).strip(), match.group(1).strip())
+        if not candidates:
+            return text, None, None
+
+        longest = None
+        for when_text in sorted(candidates, key=len, reverse=True):
+            when, repetition = try_parse_when(when_text, ctx) # may be None
+            if when:
+                return candidates[when_text], when, repetition
+            if longest is None:
+                longest = (candidates[when_text], when, repetition)
+        # none of them parsed
+        return longest
 
     # Order: "remind" <when> "to" <what>
-    user = message.user()
+    message = ctx.message
+    user = ctx.user
     reminder_without_when = None
-    reminder2 = regex("(?:remind me|remind us|reminder) (.*?) to (.*)")
-    match = reminder2.search(message.text)
+    match = REMIND_WHEN_WHAT.search(message.text)
     if match:
         reminder_text = match.group(2)
-        when, repetition = try_parse_when(match.group(1), user)
+        when, repetition = try_parse_when(match.group(1), ctx)
         if when:
             return Reminder(reminder_text, when, repetition, user.name, message.conv_id, message.db)
         else:
             reminder_without_when = reminder_text
 
     # Order: "remind" <what> "to" <when>
-    match = regex("(?:remind me|remind us|reminder) to (.*)").search(message.text)
+    match = REMIND_WHAT_WHEN.search(message.text)
     if match:
         reminder_text, when, repetition = split_reminder_when(match.group(1))
         return Reminder(reminder_text, when, repetition, user.name, message.conv_id, message.db)
@@ -217,24 +407,24 @@ def try_parse_reminder(message):
 
 def try_parse_timezone(text):
     text = text.strip(" .?!,")
-    start_tzs = [regex(p + "(.*)") for p in ("timezone", "time zone")]
-    et = [regex(p + "$") for p in ("et", "eastern", "us/eastern")]
-    pt = [regex(p + "$") for p in ("pt", "pacific", "us/pacific")]
-    for start_tz in start_tzs:
+    for start_tz in TIMEZONE_STARTS:
         match = start_tz.search(text)
         if match:
-            rest = match.group(1)
-            words = rest.split(" ")
+            words = [word.strip(" .?!,:") for word in match.group(1).split()]
+            words = [word for word in words if word]
+            # the whole answer, e.g. "to new york"
+            start = 0
+            while start < len(words) and words[start].lower() in TIMEZONE_FILLERS:
+                start += 1
+            if start < len(words):
+                tz = timezones.resolve(" ".join(words[start:]))
+                if tz:
+                    return tz, True
+            # or a zone's name in a sentence, e.g. "to US/Pacific please"
             for word in words:
-                if any([e.match(word) for e in et]):
-                    return "US/Eastern", True
-                if any([p.match(word) for p in pt]):
-                    return "US/Pacific", True
-                try:
-                    pytz.timezone(word)
-                    return word, True
-                except pytz.exceptions.UnknownTimeZoneError:
-                    pass
+                tz = timezones.resolve_word(word)
+                if tz:
+                    return tz, True
             return None, True
     return None, False
 
@@ -289,7 +479,7 @@ def try_parse_ack(text, config):
             "thanx", "thanku", "thankyou", "thank u")
     if text in acks:
         return True
-    words = re.split(r"\W+", text)
+    words = NON_WORDS.split(text)
     if all(word in acks for word in words):
         return True
     return None
@@ -304,9 +494,7 @@ def try_parse_greeting(text, config):
 
 def try_parse_undo(text, config):
     text = heavy_cleanup(text, config.username)
-    undos = ("undo", "never ?mind", "no", "undo that", "delete that", "nvm")
-    for undo in undos:
-        r = regex("(^|\s)" + undo + "($|\s)")
+    for r in UNDOS:
         if r.search(text):
             return True
     return None
@@ -317,7 +505,7 @@ delete_patterns = [regex(d + " (.*) reminder") for d in delete_words] \
         for a in ("in", "at", "on", "to", "for", "about")]
 delete_idx_patterns = [regex(d + " .*[^\w](\d+)") for d in delete_words]
 
-def try_parse_delete_by_when_or_what(text, reminders, user):
+def try_parse_delete_by_when_or_what(text, reminders, ctx):
     # delete the 10am reminder
     # delete the meeting reminder
     # delete the reminder for 10am
@@ -333,54 +521,54 @@ def try_parse_delete_by_when_or_what(text, reminders, user):
         if match:
             match_text = match.group(1)
             text_matches.append(match_text)
-            when, _ = try_parse_when(match_text, user)
+            when, _ = try_parse_when(match_text, ctx)
             if when:
                 when_matches.append(when)
 
     if len(text_matches) == len(when_matches) == 0:
         return None
 
-    reminder_matches = []
-    reminder_x_when = itertools.product(reminders, when_matches)
-    reminder_x_text = itertools.product(reminders, text_matches)
-
-    for (reminder, when) in reminder_x_when:
-        if abs(reminder.reminder_time - when) < timedelta(minutes=1):
-            reminder_matches.append((reminder, 10))
-        elif reminder.reminder_time == when + timedelta(days=1):
-            reminder_matches.append((reminder, 5))
-
-    for (reminder, text) in reminder_x_text:
+    # The words of each text match that could be in a reminder's body
+    text_words = []
+    for text in text_matches:
         tagged_words = nltk.pos_tag(nltk.word_tokenize(text), tagset='universal')
-        words = [word for (word, tag) in tagged_words if tag in ["ADJ", "NOUN", "NUM", "VERB", "X"]]
-        matches = len([w for w in nltk.word_tokenize(reminder.body) if w in words])
-        if matches:
-            reminder_matches.append((reminder, matches**2))
+        text_words.append([word for (word, tag) in tagged_words if tag in ["ADJ", "NOUN", "NUM", "VERB", "X"]])
+
+    # The best scoring reminder, where a match by when wins a tie with a match by text.
+    best_when = (None, 0)
+    if when_matches:
+        for reminder in reminders:
+            for when in when_matches:
+                if abs(reminder.reminder_time - when) < timedelta(minutes=1):
+                    score = 10
+                elif reminder.reminder_time == when + timedelta(days=1):
+                    score = 5
+                else:
+                    continue
+                if score > best_when[1]:
+                    best_when = (reminder, score)
+    best_text = reminders.best_text_match(text_words) if text_words else (None, 0)
 
-    if len(reminder_matches) == 0:
+    if best_when[0] is None and best_text[0] is None:
         return None
-
-    return max(reminder_matches, key=lambda w_s: w_s[1])[0]
+    return best_when[0] if best_when[1] >= best_text[1] else best_text[0]
 
 def try_parse_delete_by_idx(text, reminders):
     for r in delete_idx_patterns:
         match = r.search(text)
         if match:
             i = int(match.group(1))
-            if 0 < i <= len(reminders):
-                return reminders[i-1]
-
-def try_parse_delete(message, reminders):
-
-    if len(reminders) == 0:
-        return None
+            reminder = reminders.at(i-1) if 0 < i else None
+            if reminder:
+                return reminder
 
+def try_parse_delete(ctx, reminders):
     # Try when before idx because idx would incorrectly match on when
-    r = try_parse_delete_by_when_or_what(message.text, reminders, message.user())
+    r = try_parse_delete_by_when_or_what(ctx.message.text, reminders, ctx)
     if r:
         return r
 
-    r = try_parse_delete_by_idx(message.text, reminders)
+    r = try_parse_delete_by_idx(ctx.message.text, reminders)
     if r:
         return r
 
@@ -393,16 +581,16 @@ def try_parse_nodebug(text):
 
 SnoozeData = namedtuple("SnoozeData", ["phrase", "time"])
 
-def try_parse_snooze(text, user, config):
-    text = heavy_cleanup(text, config.username)
-    match = regex(r"^snooze\s+(?:for)?\s*(.*)$").match(text)
+def try_parse_snooze(text, ctx):
+    text = heavy_cleanup(text, ctx.config.username)
+    match = SNOOZE.match(text)
     if not match and text != "snooze":
         return None
     if match:
         phrase = match.group(1)
     else:
         phrase = "10 minutes"
-    t, _ = try_parse_when("in " + phrase, user)
+    t, _ = try_parse_when("in " + phrase, ctx)
     if t:
         return SnoozeData(phrase, t)
 
@@ -423,27 +611,39 @@ def parse_message(message, conv, config):
     if message.text.startswith("!"):
         message.text = message.text[1:]
 
-    reminder = try_parse_delete(message, conv.get_all_reminders())
-    if reminder:
-        return (MSG_DELETE, reminder)
-
-    reminder = try_parse_reminder(message)
-    if reminder:
-        return (MSG_REMINDER, reminder)
-
-    if "help" in message.text.lower():
+    # Rule out the parsers that can't match before running any of them (e.g. so the reminders
+    # aren't read unless this could be a delete). Each of these words has to be in the text for
+    # its parser to match.
+    lower = message.text.lower()
+    might_delete = any(word in lower for word in delete_words)
+    might_remind = "remind" in lower
+    might_set_timezone = "timezone" in lower or "time zone" in lower
+
+    ctx = ParseContext(message, conv, config)
+    if might_delete:
+        reminder = try_parse_delete(ctx, conv.upcoming_reminders())
+        if reminder:
+            return (MSG_DELETE, reminder)
+
+    if might_remind:
+        reminder = try_parse_reminder(ctx)
+        if reminder:
+            return (MSG_REMINDER, reminder)
+
+    if "help" in lower:
         return (MSG_HELP, None)
 
     if conv.context == conversation.CTX_WHEN:
-        when, repetition = try_parse_when(message.text, message.user())
+        when, repetition = try_parse_when(message.text, ctx)
         if when is not None:
             return (MSG_WHEN, (when, repetition))
 
-    tz, attempted = try_parse_timezone(message.text)
-    if tz is not None:
-        return (MSG_TIMEZONE, tz)
-    if attempted:
-        return (MSG_UNKNOWN_TZ, None)
+    if might_set_timezone:
+        tz, attempted = try_parse_timezone(message.text)
+        if tz is not None:
+            return (MSG_TIMEZONE, tz)
+        if attempted:
+            return (MSG_UNKNOWN_TZ, None)
 
     if try_parse_list(message.text):
         return (MSG_LIST, None)
@@ -474,7 +674,7 @@ def parse_message(message, conv, config):
         return (MSG_NODEBUG, None)
 
     if conv.context == conversation.CTX_REMINDED:
-        data = try_parse_snooze(message.text, message.user(), config)
+        data = try_parse_snooze(message.text, ctx)
         if data:
             return (MSG_SNOOZE, data)
 
@@ -1,12 +1,12 @@
 # Reminders
 
-import random, sqlite3, time
+import random, time
 from collections import namedtuple
 from datetime import timedelta
 from dateutil.relativedelta import *
 from pytz import timezone
 
-import util
+import database, scheduler, util, wordindex
 from user import User
 
 OK = ["Ok!", "Gotcha.", "Sure thing!", "Alright.", "You bet.", "Got it."]
@@ -30,6 +30,82 @@ INTERVALS = {
 
 Repetition = namedtuple("Repetition", ["interval", "nth"])
 
+# The intervals that are always the same length
+FIXED_INTERVALS = {
+    INTERVAL_MINUTE: timedelta(minutes=1),
+    INTERVAL_HOUR: timedelta(hours=1),
+    INTERVAL_DAY: timedelta(days=1),
+    INTERVAL_WEEK: timedelta(days=7),
+}
+
+# The first occurrence of a reminder at t repeating every nth interval that isn't before
+# `after`, and is at least one step past t. The same as applying INTERVALS one step at a time,
+# without stepping through every occurrence the bot missed while it was down.
+def next_occurrence(t, interval, nth, after):
+    if interval in FIXED_INTERVALS:
+        step = FIXED_INTERVALS[interval] * nth
+        # steps needed, rounded up
+        k = max(1, -((t - after) // step))
+        return t + step * k
+    if interval == INTERVAL_WEEKDAY:
+        return _next_weekday_occurrence(t, nth, after)
+    months = nth * (12 if interval == INTERVAL_YEAR else 1)
+    return _next_calendar_occurrence(t, months, after)
+
+# The longest one step can be, e.g. 3 days for a weekday (Friday to Monday).
+def _longest_step(interval, nth):
+    if interval in FIXED_INTERVALS:
+        return FIXED_INTERVALS[interval] * nth
+    if interval == INTERVAL_WEEKDAY:
+        return timedelta(days=3 * nth)
+    return timedelta(days=31 * nth * (12 if interval == INTERVAL_YEAR else 1))
+
+# The last occurrence after t that isn't after `before`, or t if there's none.
+def latest_occurrence(t, interval, nth, before):
+    latest = t
+    candidate = next_occurrence(t, interval, nth, before - _longest_step(interval, nth))
+    # then at most a step or two
+    while candidate <= before:
+        latest = candidate
+        candidate = INTERVALS[interval](candidate, nth)
+    return latest
+
+def _next_weekday_occurrence(t, nth, after):
+    # How far one step goes only depends on the day of the week, so the steps repeat as soon as
+    # a day of the week comes around again. Step until then, and skip the whole cycles.
+    step = INTERVALS[INTERVAL_WEEKDAY]
+    seen = {}
+    new = step(t, nth)
+    while new < after:
+        if new.weekday() in seen:
+            cycle = new - seen[new.weekday()]
+            new += cycle * ((after - new) // cycle)
+            while new < after:
+                new = step(new, nth)
+            return new
+        seen[new.weekday()] = new
+        new = step(new, nth)
+    return new
+
+def _next_calendar_occurrence(t, months, after):
+    # Stepping only differs from adding all the months at once while days past the 28th are
+    # being clipped to the end of shorter months (Jan 31 -> Feb 28 -> Mar 28, not Mar 31).
+    new = t + relativedelta(months=months)
+    while new < after and new.day > 28:
+        new += relativedelta(months=months)
+    if new >= after:
+        return new
+    k = ((after.year - new.year) * 12 + after.month - new.month) // months - 1
+    new += relativedelta(months=months * max(k, 0))
+    while new < after:
+        new += relativedelta(months=months)
+    return new
+
+# After the nth failed send, wait about RETRY_BASE_SECONDS * 2^(n-1) (up to RETRY_MAX_SECONDS)
+# before trying again.
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 60 * 60
+
 class Reminder(object):
     def __init__(self, body, time, repetition, username, conv_id, db):
         # time is a datetime in utc
@@ -43,11 +119,11 @@ class Reminder(object):
         self.id = None # when it's from the DB
         self.db = db
         self.errors = 0
+        self.next_attempt_time = None # after a failed send
 
     @classmethod
     def lookup(cls, rowid, db):
-        with sqlite3.connect(db) as c:
-            c.row_factory = sqlite3.Row
+        with database.connect(db) as c:
             cur = c.cursor()
             cur.execute('select rowid, * from reminders where rowid=?', (rowid,))
             row = cur.fetchone()
@@ -63,6 +139,8 @@ class Reminder(object):
         reminder.id = row["rowid"]
         reminder.deleted = row["deleted"]
         reminder.errors = row["errors"]
+        if row["next_attempt_time"]:
+            reminder.next_attempt_time = util.from_ts(row["next_attempt_time"])
         return reminder
 
     def get_user(self):
@@ -73,44 +151,76 @@ class Reminder(object):
         assert self.id is not None
         self.reminder_time = time
         self.repetition = repetition
-        with sqlite3.connect(self.db) as c:
+        with database.connect(self.db) as c:
             c.execute('update reminders set reminder_time=?, repetition_interval=?, repetition_nth=? where rowid=?',
                     (util.to_ts(time), repetition.interval, repetition.nth, self.id))
+        scheduler.reminder_changed(self)
 
     def delete(self):
         self.deleted = True
         assert self.id is not None
-        with sqlite3.connect(self.db) as c:
+        with database.connect(self.db) as c:
             cur = c.cursor()
             cur.execute('update reminders set deleted=1 where rowid=?', (self.id,))
             assert cur.rowcount == 1
+        scheduler.reminder_changed(self)
+        wordindex.reminder_changed(self)
 
     def undelete(self):
         self.deleted = False
         assert self.id is not None
-        with sqlite3.connect(self.db) as c:
+        with database.connect(self.db) as c:
             c.execute('update reminders set deleted=0 where rowid=?', (self.id,))
+        scheduler.reminder_changed(self)
+        wordindex.reminder_changed(self)
 
+    # Returns the snoozed reminder. That's this one, unless it repeats: then it's a new one-off
+    # copy, and this one stays on its schedule.
     def snooze_until(self, t):
         assert self.id is not None
         assert t is not None
+        if self.repeats():
+            snoozed = Reminder(self.body, t, None, self.username, self.conv_id, self.db)
+            snoozed.store()
+            return snoozed
         self.deleted = False
         self.reminder_time = t
         self.repetition = Repetition(None, None)
-        with sqlite3.connect(self.db) as c:
+        with database.connect(self.db) as c:
             c.execute('UPDATE reminders SET deleted=0, reminder_time=?, repetition_interval=?, repetition_nth=? WHERE rowid=?',
                       (util.to_ts(self.reminder_time), None, None, self.id,))
+        scheduler.reminder_changed(self)
+        wordindex.reminder_changed(self)
+        return self
 
-    def increment_error(self):
+    # Call when sending the reminder failed. It will be tried again later, with exponential
+    # backoff, until it has failed more than error_limit times. Then (or right away if the error
+    # is permanent) it's moved to the dead_reminders table.
+    def send_failed(self, error, error_limit, permanent=False):
         assert self.id is not None
         self.errors += 1
-        with sqlite3.connect(self.db) as c:
-            c.execute('UPDATE reminders SET errors=? WHERE rowid=?', (self.errors, self.id))
+        if permanent or self.errors > error_limit:
+            self.deleted = True
+            with database.connect(self.db) as c:
+                c.execute('''INSERT INTO dead_reminders (reminder_rowid, reminder_time, created_time,
+                    body, user, conv_id, repetition_interval, repetition_nth, errors, error, dead_time)
+                    SELECT rowid, reminder_time, created_time, body, user, conv_id, repetition_interval,
+                    repetition_nth, ?, ?, ? FROM reminders WHERE rowid=?''',
+                    (self.errors, error, util.to_ts(util.now_utc()), self.id))
+                c.execute('UPDATE reminders SET errors=?, deleted=1 WHERE rowid=?', (self.errors, self.id))
+        else:
+            delay = util.backoff(self.errors - 1, RETRY_BASE_SECONDS, RETRY_MAX_SECONDS)
+            self.next_attempt_time = util.now_utc() + timedelta(seconds=delay)
+            with database.connect(self.db) as c:
+                c.execute('UPDATE reminders SET errors=?, next_attempt_time=? WHERE rowid=?',
+                        (self.errors, util.to_ts(self.next_attempt_time), self.id))
+        scheduler.reminder_changed(self)
+        wordindex.reminder_changed(self)
 
     def store(self):
         reminder_ts = util.to_ts(self.reminder_time) if self.reminder_time else None
         created_ts = util.to_ts(self.created_time)
-        with sqlite3.connect(self.db) as c:
+        with database.connect(self.db) as c:
             cur = c.cursor()
             cur.execute('''insert into reminders (
                 reminder_time,
@@ -133,14 +243,17 @@ class Reminder(object):
                 self.repetition.nth,
                 self.errors))
             self.id = cur.lastrowid
+        scheduler.reminder_changed(self)
+        wordindex.reminder_changed(self)
 
     def human_time(self, full=False, preposition=True):
-        assert self.reminder_time is not None
         user_tz = self.get_user().timezone
-        now = util.now_utc()
+        return self.format_time(user_tz, local_timezone(user_tz), util.now_utc(), full, preposition)
+
+    # human_time, given the user's timezone setting, the pytz timezone for it, and now.
+    def format_time(self, user_tz, tz, now, full=False, preposition=True):
+        assert self.reminder_time is not None
         delta = self.reminder_time - now
-        # Default timezone to US/Eastern TODO magic string used in a couple places
-        tz = timezone(user_tz) if user_tz else timezone('US/Eastern')
         needs_date = full or delta.total_seconds() > 60 * 60 * 16 # today-ish
         needs_day = full or (needs_date and delta.days > 7)
         needs_year = full or (needs_day and self.reminder_time.year != now.year)
@@ -190,15 +303,51 @@ class Reminder(object):
     def repeats(self):
         return self.repetition.interval != None
 
+    # Whether the occurrence after this one is already past too, i.e. more than one was missed.
+    def is_stale(self):
+        if not self.repeats():
+            return False
+        return INTERVALS[self.repetition.interval](self.reminder_time, self.repetition.nth) < util.now_utc()
+
+    # For a repeating reminder that was missed more than once: moves it to the latest of the
+    # missed occurrences, so it's sent once for all of them.
+    def collapse_missed(self):
+        assert self.id is not None
+        self.reminder_time = latest_occurrence(self.reminder_time, self.repetition.interval,
+                self.repetition.nth, util.now_utc())
+        with database.connect(self.db) as c:
+            c.execute('UPDATE reminders SET reminder_time=? WHERE rowid=?',
+                    (util.to_ts(self.reminder_time), self.id))
+        scheduler.reminder_changed(self)
+
+    # Moves a repeating reminder on to its next occurrence, keeping the same row.
+    # Returns False if it doesn't repeat.
     def set_next_reminder(self):
         if not self.repeats():
-            return
-        new_time = INTERVALS[self.repetition.interval](self.reminder_time, self.repetition.nth)
+            return False
+        assert self.id is not None
         # In case the reminder was older than now (maybe bot was offline), make sure the next reminder is in the future:
-        while new_time < util.now_utc():
-            new_time = INTERVALS[self.repetition.interval](new_time, self.repetition.nth)
-        new_reminder = Reminder(self.body, new_time, self.repetition, self.username, self.conv_id, self.db)
-        new_reminder.store()
+        self.reminder_time = next_occurrence(self.reminder_time, self.repetition.interval,
+                self.repetition.nth, util.now_utc())
+        self.errors = 0
+        self.next_attempt_time = None
+        with database.connect(self.db) as c:
+            c.execute('UPDATE reminders SET reminder_time=?, errors=0, next_attempt_time=NULL WHERE rowid=?',
+                    (util.to_ts(self.reminder_time), self.id))
+        scheduler.reminder_changed(self)
+        return True
+
+    # Keeps a record of the reminder being sent (see Config.log_sent_reminders).
+    def log_sent(self):
+        assert self.id is not None
+        with database.connect(self.db) as c:
+            c.execute('INSERT INTO sent_reminders (reminder_rowid, reminder_time, sent_time) VALUES (?,?,?)',
+                    (self.id, util.to_ts(self.reminder_time), util.to_ts(util.now_utc())))
+
+    # Where this reminder is in the order of get_due_reminders. Take it before sending, since
+    # sending a repeating reminder moves it on.
+    def page_key(self):
+        return (util.to_ts(self.reminder_time), self.id)
 
     def confirmation(self):
         return random.choice(OK) + " I'll remind you to " + self.body + " " + self.human_time()
@@ -206,13 +355,59 @@ class Reminder(object):
     def reminder_text(self):
         return ":bell: *Reminder:* " + self.body
 
-def get_due_reminders(db, error_limit):
+def local_timezone(user_tz):
+    # Default timezone to US/Eastern TODO magic string used in a couple places
+    return timezone(user_tz) if user_tz else timezone('US/Eastern')
+
+# The lines listing these reminders ("1. foo - on Monday April 9 2018 at 9:02 PM\n"), looking
+# up each user and timezone only once.
+def list_lines(reminders):
+    now = util.now_utc()
+    zones = {} # username -> (timezone setting, pytz timezone)
+    lines = []
+    for i, reminder in enumerate(reminders, start=1):
+        if reminder.username not in zones:
+            user_tz = reminder.get_user().timezone
+            zones[reminder.username] = (user_tz, local_timezone(user_tz))
+        user_tz, tz = zones[reminder.username]
+        lines.append("".join((str(i), ". ", reminder.body, " - ",
+            reminder.format_time(user_tz, tz, now, full=True), "\n")))
+    return lines
+
+# Most due reminders handed out at once
+DUE_LIMIT = 100
+
+# Due reminders that aren't waiting to retry, oldest first, ordered by (reminder_time, rowid).
+# To get the next page, pass page_key() of the last reminder of this one as `after`.
+DUE_QUERY = '''SELECT rowid, * FROM reminders WHERE reminder_time<=? AND deleted=0 AND errors<=?
+    AND (next_attempt_time IS NULL OR next_attempt_time<=?)
+    AND (? IS NULL OR (reminder_time, rowid) > (?, ?))
+    ORDER BY reminder_time, rowid LIMIT ?'''
+
+def get_due_reminders(db, error_limit, after=None, limit=DUE_LIMIT):
     reminders = []
     now_ts = util.to_ts(util.now_utc())
-    with sqlite3.connect(db) as c:
-        c.row_factory = sqlite3.Row
+    after_ts, after_id = after if after else (None, None)
+    with database.connect(db) as c:
         cur = c.cursor()
-        cur.execute('SELECT rowid, * FROM reminders WHERE reminder_time<=? AND deleted=0 AND errors<=? LIMIT 100', (now_ts, error_limit))
+        cur.execute(DUE_QUERY, (now_ts, error_limit, now_ts, after_ts, after_ts, after_id, limit))
         for row in cur:
             reminders.append(Reminder.from_row(row, db))
     return reminders
+
+# Reminders that were given up on, most recent first, as sqlite3.Rows.
+def get_dead_reminders(db):
+    with database.connect(db) as c:
+        return c.execute('SELECT rowid, * FROM dead_reminders ORDER BY dead_time DESC').fetchall()
+
+# Moves a dead reminder back into the reminders table, due now. Returns the new Reminder.
+def replay_dead_reminder(dead_id, db):
+    with database.unit_of_work(db):
+        with database.connect(db) as c:
+            row = c.execute('SELECT rowid, * FROM dead_reminders WHERE rowid=?', (dead_id,)).fetchone()
+            assert row is not None, "no dead reminder " + str(dead_id)
+            c.execute('DELETE FROM dead_reminders WHERE rowid=?', (dead_id,))
+        repetition = Repetition(row["repetition_interval"], row["repetition_nth"]) if row["repetition_interval"] else None
+        reminder = Reminder(row["body"], util.now_utc(), repetition, row["user"], row["conv_id"], db)
+        reminder.store()
+    return reminder
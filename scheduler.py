@@ -0,0 +1,136 @@
+# Waking the reminder loop when reminders are due
+
+import asyncio, heapq, threading
+
+import database, util
+
+# Without any changes the loop still checks the database this often, in case reminders were
+# added by something other than this process.
+MAX_SLEEP_SECONDS = 60
+
+# The running scheduler for each db file. Models notify it through reminder_changed() and
+# user_changed(); without one (e.g. in tests) notifications do nothing.
+_schedulers = {}
+
+class Scheduler(object):
+    '''
+    A min-heap of (reminder_time, rowid) for every reminder that is waiting to be sent.
+    Entries whose reminder was since rescheduled or deleted are left in the heap and skipped
+    when they reach the top.
+    '''
+    def __init__(self, db, error_limit):
+        self.db = db
+        self.error_limit = error_limit
+        self.heap = []
+        self.times = {} # rowid -> reminder ts, for the live entries
+        self.lock = threading.Lock()
+        self.loop = None
+        self.changed = None
+
+    def load(self):
+        # Reads every upcoming reminder from the db. Call on the database thread.
+        with database.connect(self.db) as c:
+            rows = c.execute('''SELECT rowid, max(reminder_time, ifnull(next_attempt_time, 0)) FROM reminders
+                WHERE reminder_time NOT NULL AND deleted=0 AND errors<=?''', (self.error_limit,)).fetchall()
+        with self.lock:
+            self.times = {row[0]: row[1] for row in rows}
+            self.heap = [(ts, rowid) for rowid, ts in self.times.items()]
+            heapq.heapify(self.heap)
+        self._wake()
+
+    def schedule(self, rowid, ts):
+        with self.lock:
+            self.times[rowid] = ts
+            heapq.heappush(self.heap, (ts, rowid))
+            earliest = self._peek() == ts
+        if earliest:
+            self._wake()
+
+    def cancel(self, rowid):
+        with self.lock:
+            self.times.pop(rowid, None)
+
+    def reload_user(self, username):
+        with database.connect(self.db) as c:
+            rows = c.execute('''SELECT rowid, max(reminder_time, ifnull(next_attempt_time, 0)) FROM reminders
+                WHERE user=? AND reminder_time NOT NULL AND deleted=0 AND errors<=?''',
+                (username, self.error_limit)).fetchall()
+        for rowid, ts in rows:
+            self.schedule(rowid, ts)
+
+    def _wake(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.changed.set)
+
+    def next_ts(self):
+        # When the earliest scheduled reminder is due, or None.
+        with self.lock:
+            return self._peek()
+
+    def _peek(self):
+        # Call with the lock held.
+        while self.heap:
+            ts, rowid = self.heap[0]
+            if self.times.get(rowid) == ts:
+                return ts
+            heapq.heappop(self.heap)
+        return None
+
+    def _pop_due(self, now_ts):
+        with self.lock:
+            while True:
+                ts = self._peek()
+                if ts is None or ts > now_ts:
+                    return
+                _, rowid = heapq.heappop(self.heap)
+                del self.times[rowid]
+
+    async def wait(self):
+        # Sleeps until a reminder is due (then returns), re-arming whenever the schedule changes.
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self.changed = asyncio.Event()
+        while True:
+            self.changed.clear()
+            now_ts = util.to_ts(util.now_utc())
+            with self.lock:
+                next_ts = self._peek()
+            if next_ts is not None and next_ts <= now_ts:
+                self._pop_due(now_ts)
+                return
+            timeout = MAX_SLEEP_SECONDS if next_ts is None else min(next_ts - now_ts, MAX_SLEEP_SECONDS)
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                if next_ts is None or next_ts - now_ts > MAX_SLEEP_SECONDS:
+                    return
+
+def start(db, error_limit):
+    scheduler = Scheduler(db, error_limit)
+    _schedulers[db] = scheduler
+    return scheduler
+
+def stop(db):
+    _schedulers.pop(db, None)
+
+def reminder_changed(reminder):
+    # Call after writing a reminder's time, deleted flag, errors or next attempt.
+    scheduler = _schedulers.get(reminder.db)
+    if scheduler is None or reminder.id is None:
+        return
+    rowid = reminder.id
+    if reminder.deleted or reminder.reminder_time is None or reminder.errors > scheduler.error_limit:
+        update = lambda: scheduler.cancel(rowid)
+    else:
+        ts = util.to_ts(reminder.reminder_time)
+        if reminder.next_attempt_time:
+            # it's failing to send, wait until it's time to try again
+            ts = max(ts, util.to_ts(reminder.next_attempt_time))
+        update = lambda: scheduler.schedule(rowid, ts)
+    database.after_commit(reminder.db, update)
+
+def user_changed(user):
+    # Call after shifting the times of all of a user's reminders.
+    scheduler = _schedulers.get(user.db)
+    if scheduler is not None:
+        database.after_commit(user.db, lambda: scheduler.reload_user(user.name))
@@ -0,0 +1,71 @@
+# Turning what people call their timezone into a pytz name
+
+import pytz
+
+# Shorthand that can only mean one zone, even picked out of a sentence (see resolve_word).
+WORD_ALIASES = {
+    "et": "US/Eastern", "eastern": "US/Eastern", "edt": "US/Eastern",
+    "ct": "US/Central", "cdt": "US/Central",
+    "mt": "US/Mountain", "mdt": "US/Mountain",
+    "pt": "US/Pacific", "pacific": "US/Pacific", "pst": "US/Pacific", "pdt": "US/Pacific",
+    "akst": "US/Alaska", "akdt": "US/Alaska",
+}
+
+# Shorthand that's only taken as the whole answer ("la", but not the "la" of "la paz").
+ALIASES = {
+    "east": "US/Eastern", "east coast": "US/Eastern", "nyc": "US/Eastern",
+    "central": "US/Central", "cst": "US/Central", "mountain": "US/Mountain",
+    "west": "US/Pacific", "west coast": "US/Pacific", "sf": "US/Pacific", "la": "US/Pacific",
+    "bst": "Europe/London", "ist": "Asia/Kolkata", "jst": "Asia/Tokyo", "kst": "Asia/Seoul",
+    "aest": "Australia/Sydney", "aedt": "Australia/Sydney",
+}
+
+# The shortest start of a name that's looked up (if only one zone's names start with it, and
+# it's at least half the name, so "chica" is Chicago but "cape" isn't Cape Verde).
+MIN_PREFIX = 4
+
+def _key(name):
+    return name.strip().lower().replace(" ", "_")
+
+def _cities():
+    # "new_york" -> "America/New_York", for the cities that are the last part of just one zone.
+    # Common zones win over the old names for the same place.
+    cities = {}
+    for zones in (pytz.common_timezones, pytz.all_timezones):
+        found = {}
+        for zone in zones:
+            if "/" in zone:
+                found.setdefault(_key(zone.rsplit("/", 1)[1]), set()).add(zone)
+        for city, matches in found.items():
+            if city not in cities and len(matches) == 1:
+                cities[city] = matches.pop()
+    return cities
+
+def _build():
+    words = dict((_key(alias), zone) for alias, zone in WORD_ALIASES.items())
+    words.update((_key(zone), zone) for zone in pytz.all_timezones)
+    names = _cities()
+    names.update((_key(alias), zone) for alias, zone in ALIASES.items())
+    # names pytz knows (like EST, a fixed UTC-5 with no daylight saving) keep their pytz
+    # meaning over any alias
+    names.update(words)
+    prefixes = {}
+    for name, zone in names.items():
+        for end in range(max(MIN_PREFIX, (len(name) + 1) // 2), len(name)):
+            prefixes.setdefault(name[:end], set()).add(zone)
+    prefixes = {prefix: zones.pop() for prefix, zones in prefixes.items() if len(zones) == 1}
+    return words, names, prefixes
+
+_words, _names, _prefixes = _build()
+
+def resolve(name):
+    # The pytz name of the timezone, or None, for a whole answer like "new york". Ignores case,
+    # and takes aliases ("pacific"), cities ("new york", "Chicago") and the start of any of them
+    # ("chica").
+    key = _key(name)
+    return _names.get(key) or _prefixes.get(key)
+
+def resolve_word(word):
+    # Like resolve, for a word picked out of a sentence: only pytz names ("US/Pacific", "gmt")
+    # and WORD_ALIASES, which can't be part of something else.
+    return _words.get(_key(word))
@@ -1,8 +1,11 @@
 # The User
 
-import json, sqlite3
+import database, scheduler, timezones, util
 
-import util
+# Users that were looked up recently, by (db, name). Like conversations, there's one User object
+# per user and changes are written through, so a cached one is always up to date.
+CACHE_SIZE = 1000
+_cache = util.LRUCache("users.cache", CACHE_SIZE)
 
 class User(object):
     def __init__(self, name, timezone, db):
@@ -13,58 +16,76 @@ class User(object):
 
     @classmethod
     def lookup(cls, name, db):
-        with sqlite3.connect(db) as c:
+        user = _cache.get((db, name))
+        if user is not None:
+            return user
+        with database.connect(db) as c:
             cur = c.cursor()
-            cur.execute('select username, settings from users where username=?', (name,))
+            cur.execute('select timezone, has_seen_help from users where username=?', (name,))
             row = cur.fetchone()
         if row is None:
             user = User(name, None, db)
             user.store()
+            _cache.put((db, name), user)
+            database.after_rollback(db, user._uncache)
             return user
-        settings = json.loads(row[1])
-        user = User(name, settings['timezone'], db)
-        if 'has_seen_help' in settings:
-            user.has_seen_help = settings['has_seen_help']
+        user = User(name, row[0], db)
+        user.has_seen_help = bool(row[1])
+        _cache.put((db, name), user)
         return user
 
     def set_timezone(self, timezone):
+        canonical = timezones.resolve(timezone)
+        if canonical is None:
+            raise ValueError('Unknown timezone: {}'.format(timezone))
         prev_timezone = self.timezone
-        self.timezone = timezone
+        self.timezone = canonical
         # update timezone of all future reminders
-        with sqlite3.connect(self.db) as c:
-            self.save_settings_inner(c) # transactional with the reminders update
-            if prev_timezone:
-                diff = util.timezone_diff(prev_timezone, timezone)
-                c.execute('''update reminders set reminder_time=(reminder_time + ?)
-                    where user=? and reminder_time not null''', (diff, self.name))
+        try:
+            with database.connect(self.db) as c:
+                self.save_settings_inner(c) # transactional with the reminders update
+                if prev_timezone:
+                    diff = util.timezone_diff(prev_timezone, canonical)
+                    c.execute('''update reminders set reminder_time=(reminder_time + ?)
+                        where user=? and reminder_time not null''', (diff, self.name))
+        except:
+            self._uncache()
+            raise
+        database.after_rollback(self.db, self._uncache)
+        if prev_timezone:
+            scheduler.user_changed(self)
 
     def set_seen_help(self):
         self.has_seen_help = True
         self.save_settings()
 
     def store(self):
-        with sqlite3.connect(self.db) as c:
-            c.execute('insert into users(username, settings) values (?,?)',
-                    (self.name, self.settings_json()))
+        with database.connect(self.db) as c:
+            c.execute('insert into users(username, settings, timezone, has_seen_help) values (?,?,?,?)',
+                    (self.name, '{}', self.timezone, self.has_seen_help))
 
     def save_settings(self):
-        with sqlite3.connect(self.db) as c:
-            self.save_settings_inner(c)
+        try:
+            with database.connect(self.db) as c:
+                self.save_settings_inner(c)
+        except:
+            self._uncache()
+            raise
+        database.after_rollback(self.db, self._uncache)
 
     def save_settings_inner(self, c):
         cur = c.cursor()
-        cur.execute('update users set settings=? where username=?',
-                (self.settings_json(), self.name))
+        cur.execute('update users set timezone=?, has_seen_help=? where username=?',
+                (self.timezone, self.has_seen_help, self.name))
         assert cur.rowcount == 1
 
-    def settings_json(self):
-        return json.dumps({
-            'timezone': self.timezone,
-            'has_seen_help': self.has_seen_help,
-        })
+    # The settings were changed but might not be saved, so read them from the db next time.
+    def _uncache(self):
+        _cache.pop((self.db, self.name))
 
     # Delete the user AND all their reminders
     def delete(self):
-        with sqlite3.connect(self.db) as c:
+        self._uncache()
+        with database.connect(self.db) as c:
             c.execute('delete from users where username=?', (self.name,))
             c.execute('delete from reminders where user=?', (self.name,))
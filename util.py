@@ -1,6 +1,11 @@
 import datetime
 import pytz
+import random
+import threading
 import time
+from collections import OrderedDict
+
+import metrics
 
 def now_utc():
     return datetime.datetime.now(tz=pytz.utc)
@@ -29,4 +34,52 @@ def date_suffix(d):
     return 'th' if 11<=d<=13 else {1:'st',2:'nd',3:'rd'}.get(d%10, 'th')
 
 def strftime(format, t):
-    return t.strftime(format).replace('{S}', str(t.day) + date_suffix(t.day))
\ No newline at end of file
+    return t.strftime(format).replace('{S}', str(t.day) + date_suffix(t.day))
+
+def backoff(attempt, base, max_seconds):
+    # Seconds to wait before retry number `attempt` (from 0): doubling from base, up to
+    # max_seconds, and randomized so things that failed together don't retry together.
+    return min(base * 2 ** attempt, max_seconds) * random.uniform(0.5, 1)
+
+class LRUCache(object):
+    '''
+    Holds up to `size` values, dropping the least recently used one to make room. Counts hits,
+    misses and evictions as metrics under `name`.
+    '''
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # The value, or None.
+        with self.lock:
+            value = self.values.get(key)
+            if value is not None:
+                self.values.move_to_end(key)
+        metrics.incr(self.name + (".hits" if value is not None else ".misses"))
+        return value
+
+    def peek(self, key):
+        # The value, or None, without counting it as a use.
+        with self.lock:
+            return self.values.get(key)
+
+    def put(self, key, value):
+        with self.lock:
+            self.values[key] = value
+            self.values.move_to_end(key)
+            evicted = len(self.values) > self.size
+            if evicted:
+                self.values.popitem(last=False)
+        if evicted:
+            metrics.incr(self.name + ".evictions")
+
+    def pop(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
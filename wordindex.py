@@ -0,0 +1,91 @@
+# The words in each conversation's reminders, for finding the one a message like "delete the
+# meeting reminder" means without tokenizing every reminder's body for each message.
+
+import threading
+
+import nltk
+
+import database, util
+
+# Conversations whose index is kept in memory.
+CACHE_SIZE = 200
+
+_indexes = util.LRUCache("word_index", CACHE_SIZE)
+
+class WordIndex(object):
+    '''
+    An inverted index of the bodies of a conversation's reminders that aren't deleted. Bodies are
+    tokenized the same way as before there was an index, so the scores don't change.
+    Reminders deleted behind the index's back (e.g. with their user) are left in it; callers
+    check what it finds against the db.
+    '''
+    def __init__(self):
+        self.postings = {} # word -> {rowid: times the word is in the body}
+        self.words = {} # rowid -> words of the body
+        self.lock = threading.Lock()
+
+    def add(self, rowid, body):
+        if rowid in self.words:
+            return # bodies don't change
+        words = nltk.word_tokenize(body)
+        with self.lock:
+            if rowid in self.words:
+                return
+            self.words[rowid] = words
+            for word in words:
+                counts = self.postings.setdefault(word, {})
+                counts[rowid] = counts.get(rowid, 0) + 1
+
+    def remove(self, rowid):
+        with self.lock:
+            for word in self.words.pop(rowid, ()):
+                counts = self.postings.get(word)
+                if counts is not None:
+                    counts.pop(rowid, None)
+                    if not counts:
+                        del self.postings[word]
+
+    def scores(self, word_lists):
+        # rowid -> score for every reminder with a word from one of the lists, where the score is
+        # the square of how many of its body's words are in the list it matches best.
+        scores = {}
+        with self.lock:
+            for words in word_lists:
+                matches = {}
+                for word in set(words):
+                    for rowid, count in self.postings.get(word, {}).items():
+                        matches[rowid] = matches.get(rowid, 0) + count
+                for rowid, count in matches.items():
+                    scores[rowid] = max(scores.get(rowid, 0), count**2)
+        return scores
+
+def lookup(db, conv_id):
+    # The conversation's index, read from the db the first time.
+    index = _indexes.get((db, conv_id))
+    if index is None:
+        index = WordIndex()
+        with database.connect(db) as c:
+            rows = c.execute('select rowid, body from reminders where conv_id=? and deleted=0',
+                    (conv_id,)).fetchall()
+        for rowid, body in rows:
+            index.add(rowid, body)
+        _indexes.put((db, conv_id), index)
+    return index
+
+def reminder_changed(reminder):
+    # Call after storing a reminder or changing its deleted flag.
+    if reminder.id is None or _indexes.peek((reminder.db, reminder.conv_id)) is None:
+        return
+    rowid, body, deleted = reminder.id, reminder.body, reminder.deleted
+    def update():
+        index = _indexes.peek((reminder.db, reminder.conv_id))
+        if index is None:
+            return
+        if deleted:
+            index.remove(rowid)
+        else:
+            index.add(rowid, body)
+    database.after_commit(reminder.db, update)
+
+def conversation_deleted(db, conv_id):
+    _indexes.pop((db, conv_id))